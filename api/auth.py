@@ -1,22 +1,101 @@
 import os
 import hashlib
+import hmac
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import Optional
 import jwt
 from flask import request, jsonify
+from metrics import timed
 
 JWT_SECRET = os.environ.get("JWT_SECRET", "dev-secret-change-me")
 JWT_ALG = "HS256"
 JWT_TTL = 60 * 60 * 24 * 7  # 7 days
 
+# Verified claims are reused until the token expires or TOKEN_CACHE_TTL passes
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 300))
+
+# scrypt cost; stored hashes carry their own parameters and are upgraded on login
+SCRYPT_N = int(os.environ.get("SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", 1))
+# caps concurrent KDF runs (each takes ~128*N*r bytes) so a login burst cannot starve the instance
+KDF_WORKERS = int(os.environ.get("KDF_WORKERS", 2))
+
+_kdf_pool: Optional[ThreadPoolExecutor] = None
+_kdf_lock = threading.Lock()
+
+
+def _kdf() -> ThreadPoolExecutor:
+    global _kdf_pool
+    with _kdf_lock:
+        if _kdf_pool is None:
+            _kdf_pool = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix="kdf")
+        return _kdf_pool
+
+
+def _scrypt(pw: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(pw.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+
 
 def hash_password(pw: str) -> str:
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    """`scrypt$n$r$p$salt$hash`, computed on the KDF worker pool."""
+    salt = os.urandom(16)
+    dk = _kdf().submit(_scrypt, pw, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P).result()
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${dk.hex()}"
 
 
 def verify_password(pw: str, h: str) -> bool:
-    return hash_password(pw) == h
+    if not h.startswith("scrypt$"):
+        # accounts created before the KDF switch store a bare sha256 hex digest
+        return hmac.compare_digest(hashlib.sha256(pw.encode("utf-8")).hexdigest(), h)
+    try:
+        _, n, r, p, salt, dk = h.split("$")
+        n, r, p, salt, dk = int(n), int(r), int(p), bytes.fromhex(salt), bytes.fromhex(dk)
+    except ValueError:
+        return False
+    return hmac.compare_digest(_kdf().submit(_scrypt, pw, salt, n, r, p).result(), dk)
+
+
+def needs_rehash(h: str) -> bool:
+    return not h.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+class TokenCache:
+    """Bounded LRU of verified JWT claims keyed by the token's SHA-256."""
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[dict]:
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            claims, expires = hit
+            if time.time() >= expires:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return claims
+
+    def put(self, key: bytes, claims: dict) -> None:
+        expires = min(float(claims.get("exp", 0)), time.time() + self.ttl)
+        with self._lock:
+            self._items[key] = (claims, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+_token_cache = TokenCache()
 
 
 def create_token(user_id: int, email: str) -> str:
@@ -25,20 +104,35 @@ def create_token(user_id: int, email: str) -> str:
 
 
 def decode_token(token: str) -> Optional[dict]:
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    claims = _token_cache.get(key)
+    if claims is not None:
+        return claims
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
     except Exception:
         return None
+    _token_cache.put(key, claims)
+    return claims
+
 
+def require_auth(fn=None, *, query_token: bool = False):
+    """Bearer-token auth. `query_token=True` also accepts `?access_token=`, for routes
+    consumed by EventSource, which cannot set headers; query strings end up in logs."""
+    if fn is None:
+        return lambda f: require_auth(f, query_token=query_token)
 
-def require_auth(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
         auth = request.headers.get("Authorization", "")
-        if not auth.startswith("Bearer "):
+        if auth.startswith("Bearer "):
+            token = auth.split(" ", 1)[1]
+        elif query_token and request.args.get("access_token"):
+            token = request.args["access_token"]
+        else:
             return jsonify({"ok": False, "error": "missing_bearer_token"}), 401
-        token = auth.split(" ", 1)[1]
-        claims = decode_token(token)
+        with timed("auth"):
+            claims = decode_token(token)
         if not claims:
             return jsonify({"ok": False, "error": "invalid_token"}), 401
         request.user = {"id": claims.get("sub"), "email": claims.get("email")}
@@ -0,0 +1,12 @@
+import logging
+from concurrent.futures import Future
+from typing import Callable
+
+
+def log_failure(log: logging.Logger, what: str) -> Callable[[Future], None]:
+    """done_callback for fire-and-forget jobs: an executor keeps a job's exception in
+    its future, so without this, failures nobody waits on would pass silently."""
+    def done(fut: Future) -> None:
+        if not fut.cancelled() and fut.exception() is not None:
+            log.error("%s failed", what, exc_info=fut.exception())
+    return done
@@ -0,0 +1,201 @@
+import os
+import uuid
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import and_, delete, or_, select
+from db import DB_PATH, get_session, write_session, ColdChunk, Reading, Sensor
+
+# Compacted readings live next to the SQLite file unless COLD_DIR points elsewhere;
+# on serverless it must be storage shared by every instance
+COLD_DIR = os.environ.get("COLD_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(DB_PATH)) if "://" not in DB_PATH else os.path.dirname(__file__), "cold")
+COLD_CHUNK_ROWS = int(os.environ.get("COLD_CHUNK_ROWS", 65536))
+COLD_AFTER = float(os.environ.get("COLD_AFTER", 30 * 86400))  # compact readings older than this many seconds
+
+# A chunk is three .npy files: int deltas of the timestamps' float64 bit patterns
+# and of the row ids (lossless, usually 1-4 bytes per row), and the (n, 3) values
+# which are memory-mapped on read.
+
+
+def _delta_encode(a: np.ndarray) -> np.ndarray:
+    """a[i] - a[i-1] (0 for the first row) in the narrowest signed integer dtype."""
+    d = np.diff(a, prepend=a[:1])
+    lo, hi = (int(d.min()), int(d.max())) if d.shape[0] else (0, 0)
+    for dt in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dt)
+        if info.min <= lo and hi <= info.max:
+            return d.astype(dt)
+    return d
+
+
+def _delta_decode(first: int, d: np.ndarray) -> np.ndarray:
+    return first + np.cumsum(d, dtype=np.int64)
+
+
+def _save(path: str, a: np.ndarray) -> None:
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, a)
+    os.replace(tmp, path)
+
+
+def write_chunk(user_id: int, sensor_id: int, A: np.ndarray) -> ColdChunk:
+    """Write rows (id, timestamp, v1, v2, v3), sorted by (timestamp, id), as one chunk."""
+    ids = A[:, 0].astype(np.int64)
+    bits = np.ascontiguousarray(A[:, 1]).view(np.int64)
+    rel = os.path.join(str(user_id), str(sensor_id), f"{ids[0]}-{uuid.uuid4().hex[:12]}")
+    base = os.path.join(COLD_DIR, rel)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    _save(base + ".ts.npy", _delta_encode(bits))
+    _save(base + ".id.npy", _delta_encode(ids))
+    _save(base + ".v.npy", np.ascontiguousarray(A[:, 2:5]))
+    return ColdChunk(user_id=user_id, sensor_id=sensor_id, n=A.shape[0], t_min=float(A[0, 1]), t_max=float(A[-1, 1]),
+                     id_first=int(ids[0]), path=rel)
+
+
+@lru_cache(maxsize=16)
+def _decoded(path: str, t_min: float, id_first: int) -> Tuple[np.ndarray, np.ndarray]:
+    base = os.path.join(COLD_DIR, path)
+    ts = _delta_decode(int(np.float64(t_min).view(np.int64)), np.load(base + ".ts.npy")).view(np.float64)
+    return ts, _delta_decode(id_first, np.load(base + ".id.npy"))
+
+
+def load_chunk(c: ColdChunk) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(timestamps, ids, values); values are a read-only memory map."""
+    ts, ids = _decoded(c.path, c.t_min, c.id_first)
+    return ts, ids, np.load(os.path.join(COLD_DIR, c.path) + ".v.npy", mmap_mode="r")
+
+
+def cold_chunks(s, user_id: int, sensor_id: Optional[int] = None, since: Optional[float] = None,
+                until: Optional[float] = None) -> List[ColdChunk]:
+    """Chunks that may hold readings in [since, until), newest first."""
+    q = select(ColdChunk).where(ColdChunk.user_id == user_id)
+    if sensor_id:
+        q = q.where(ColdChunk.sensor_id == sensor_id)
+    if since is not None:
+        q = q.where(ColdChunk.t_max >= since)
+    if until is not None:
+        q = q.where(ColdChunk.t_min < until)
+    return s.execute(q.order_by(ColdChunk.t_max.desc())).scalars().all()
+
+
+def _range(ts: np.ndarray, since: Optional[float], until: Optional[float]) -> Tuple[int, int]:
+    lo = int(np.searchsorted(ts, since, "left")) if since is not None else 0
+    hi = int(np.searchsorted(ts, until, "left")) if until is not None else ts.shape[0]
+    return lo, hi
+
+
+def cold_page(chunks: List[ColdChunk], since: Optional[float], until: Optional[float],
+              after: Optional[Tuple[float, int]], limit: int) -> list:
+    """The newest limit + 1 cold rows strictly older than `after` on (timestamp, id),
+    as (id, timestamp, v1, v2, v3, sensor_id) tuples in newest-first order."""
+    if after:
+        until = min(until, np.nextafter(after[0], np.inf)) if until is not None else np.nextafter(after[0], np.inf)
+    keep = limit + 1
+    best = np.empty((0, 6))
+    for c in chunks:
+        if best.shape[0] >= keep and c.t_max < best[keep - 1, 1]:
+            break
+        ts, ids, V = load_chunk(c)
+        lo, hi = _range(ts, since, until)
+        idx = np.arange(lo, hi)
+        if after:
+            idx = idx[(ts[idx] < after[0]) | (ids[idx] < after[1])]
+        idx = idx[-keep:]
+        part = np.column_stack([ids[idx], ts[idx], V[idx], np.full(idx.shape[0], c.sensor_id)])
+        best = np.vstack([best, part])
+        best = best[np.lexsort((-best[:, 0], -best[:, 1]))][:keep]
+    return [(int(i), t, v1, v2, v3, int(sid)) for i, t, v1, v2, v3, sid in best.tolist()]
+
+
+def merge_page(hot: list, hot_more: bool, cold: list, limit: int) -> Tuple[list, bool]:
+    """Merge two newest-first keyset pages; returns (rows, more)."""
+    rows = sorted(list(hot) + cold, key=lambda r: (r[1], r[0]), reverse=True)
+    return rows[:limit], hot_more or len(rows) > limit
+
+
+def cold_batches(chunks: List[ColdChunk], since: Optional[float], until: Optional[float], hot_range) -> Iterator[np.ndarray]:
+    """(timestamp, sensor_id, v1, v2, v3) batches in timestamp order up to `cold_end(chunks)`.
+
+    The span is cut at chunk starts; each window merges the chunk slices that fall
+    into it with `hot_range(lo, hi)`, the hot rows in [lo, hi). Callers continue
+    with hot rows from `cold_end(chunks)` on.
+    """
+    chunks = sorted(chunks, key=lambda c: c.t_min)
+    end = np.nextafter(max(c.t_max for c in chunks), np.inf)
+    if until is not None:
+        end = min(end, until)
+    edges = sorted({c.t_min for c in chunks if since is None or c.t_min > since})
+    edges = [since if since is not None else -np.inf] + [e for e in edges if e < end] + [end]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        parts = [hot_range(lo, hi)]
+        for c in chunks:
+            if c.t_min >= hi:
+                break
+            if c.t_max < lo:
+                continue
+            ts, _, V = load_chunk(c)
+            a, b = _range(ts, lo, hi)
+            if b > a:
+                parts.append(np.column_stack([ts[a:b], np.full(b - a, c.sensor_id, dtype=float), V[a:b]]))
+        M = np.vstack(parts)
+        if M.shape[0]:
+            yield M[np.argsort(M[:, 0], kind="stable")]
+
+
+def cold_end(chunks: List[ColdChunk]) -> float:
+    """Hot rows at or after this timestamp are past every chunk."""
+    return float(np.nextafter(max(c.t_max for c in chunks), np.inf))
+
+
+def compact(cutoff: float, user_id: Optional[int] = None, chunk_rows: int = COLD_CHUNK_ROWS) -> int:
+    """Move readings older than `cutoff` into cold chunks, one write transaction per chunk."""
+    q = select(Sensor.id, Sensor.user_id).order_by(Sensor.id)
+    if user_id is not None:
+        q = q.where(Sensor.user_id == user_id)
+    with get_session() as s:
+        sensors = s.execute(q).all()
+    moved = 0
+    for sid, uid in sensors:
+        while True:
+            with write_session() as s:
+                oldest = (
+                    select(Reading.id, Reading.timestamp, Reading.v1, Reading.v2, Reading.v3)
+                    .where(Reading.user_id == uid, Reading.sensor_id == sid, Reading.timestamp < cutoff)
+                    .order_by(Reading.timestamp, Reading.id)
+                    .limit(chunk_rows)
+                )
+                A = np.asarray(s.execute(oldest).all(), dtype=float).reshape(-1, 5)
+                if not A.shape[0]:
+                    break
+                s.add(write_chunk(uid, sid, A))
+                # exactly the rows just written: everything up to the last (timestamp, id)
+                last_ts, last_id = float(A[-1, 1]), int(A[-1, 0])
+                s.execute(delete(Reading).where(
+                    Reading.user_id == uid, Reading.sensor_id == sid,
+                    or_(Reading.timestamp < last_ts, and_(Reading.timestamp == last_ts, Reading.id <= last_id))))
+            moved += A.shape[0]
+            if A.shape[0] < chunk_rows:
+                break
+    return moved
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from db import ensure_schema, engine
+    ap = argparse.ArgumentParser(description="Compact old readings into columnar cold chunks.")
+    ap.add_argument("--older-than", type=float, default=COLD_AFTER, help="seconds (default: COLD_AFTER)")
+    ap.add_argument("--user", type=int, help="limit to one user")
+    ap.add_argument("--vacuum", action="store_true", help="VACUUM afterwards so the SQLite file shrinks")
+    args = ap.parse_args()
+    ensure_schema()
+    print(f"moved {compact(time.time() - args.older_than, args.user)} readings to {COLD_DIR}")
+    if args.vacuum and engine.dialect.name == "sqlite":
+        # VACUUM cannot run inside a transaction; pool connections are in autocommit mode
+        raw = engine.raw_connection()
+        try:
+            raw.cursor().execute("VACUUM")
+        finally:
+            raw.close()
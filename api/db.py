@@ -1,14 +1,65 @@
 from __future__ import annotations
+import logging
 import os
+import threading
 import time
 from datetime import datetime
-from typing import List, Optional
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Text
+from contextlib import contextmanager, nullcontext
+from typing import Iterator, List, Optional
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Float, ForeignKey, DateTime, Text, LargeBinary, UniqueConstraint, Index
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from metrics import instrument_engine, timed
 
+# DB_PATH is a SQLite file path or any SQLAlchemy URL (e.g. postgresql+psycopg://...)
 DB_PATH = os.environ.get("DB_PATH", os.path.join(os.path.dirname(__file__), "app.db"))
-engine = create_engine(f"sqlite:///{DB_PATH}", echo=False, future=True)
+DB_URL = DB_PATH if "://" in DB_PATH else f"sqlite:///{DB_PATH}"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "cache_size": -int(os.environ.get("SQLITE_CACHE_KB", 20000)),  # negative => KiB
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_BYTES", 256 * 1024 * 1024)),
+    "temp_store": "MEMORY",
+}
+
+
+def _make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=False, future=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                             pool_pre_ping=True, pool_recycle=1800)
+    pool = {}
+    if make_url(url).database not in (None, "", ":memory:"):
+        # file-backed SQLite gets a QueuePool; in-memory uses SingletonThreadPool, which takes no sizes
+        pool = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+    eng = create_engine(url, echo=False, future=True, **pool,
+                        connect_args={"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000})
+
+    @event.listens_for(eng, "connect")
+    def _on_connect(dbapi_conn, _record):
+        # Take over transaction control from pysqlite so writers can BEGIN IMMEDIATE
+        dbapi_conn.isolation_level = None
+        cur = dbapi_conn.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cur.execute(f"PRAGMA {name}={value}")
+        cur.close()
+
+    @event.listens_for(eng, "begin")
+    def _on_begin(conn):
+        # Write sessions take the lock up front: waiting writers honour busy_timeout
+        # instead of failing with "database is locked" on a read->write upgrade
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if conn.get_execution_options().get("sqlite_immediate") else "BEGIN")
+
+    return eng
+
+
+engine = _make_engine(DB_URL)
+instrument_engine(engine)
+_write_lock = threading.Lock() if engine.dialect.name == "sqlite" else nullcontext()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+WriteSessionLocal = sessionmaker(bind=engine.execution_options(sqlite_immediate=True), autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 
 class User(Base):
@@ -33,10 +84,17 @@ class Sensor(Base):
 
 class Reading(Base):
     __tablename__ = "readings"
+    __table_args__ = (
+        # keyset pagination / range scans: WHERE user_id [AND sensor_id] ORDER BY timestamp, id
+        Index("ix_readings_user_sensor_ts", "user_id", "sensor_id", "timestamp"),
+        Index("ix_readings_user_ts", "user_id", "timestamp"),
+        # one reading per sensor and instant: retried batches are skipped on insert
+        Index("uq_readings_sensor_ts", "sensor_id", "timestamp", unique=True),
+    )
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, index=True, nullable=False)
-    sensor_id = Column(Integer, ForeignKey("sensors.id"), nullable=False, index=True)
-    timestamp = Column(Float, default=lambda: time.time(), index=True)
+    user_id = Column(Integer, nullable=False)
+    sensor_id = Column(Integer, ForeignKey("sensors.id"), nullable=False)
+    timestamp = Column(Float, default=lambda: time.time())
     v1 = Column(Float, nullable=False)
     v2 = Column(Float, nullable=False)
     v3 = Column(Float, nullable=False)
@@ -45,18 +103,230 @@ class Reading(Base):
 
 class Anomaly(Base):
     __tablename__ = "anomalies"
+    __table_args__ = (
+        Index("ix_anomalies_user_ts", "user_id", "timestamp"),
+        Index("ix_anomalies_user_sensor_ts", "user_id", "sensor_id", "timestamp"),
+        # MAX(id) and id > cursor per user (alert stream, feed revalidation)
+        Index("ix_anomalies_user_id_id", "user_id", "id"),
+    )
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, index=True, nullable=False)
-    sensor_id = Column(Integer, index=True, nullable=True)
-    timestamp = Column(Float, default=lambda: time.time(), index=True)
+    user_id = Column(Integer, nullable=False)
+    sensor_id = Column(Integer, nullable=True)
+    timestamp = Column(Float, default=lambda: time.time())
     score = Column(Float, nullable=False)
     explanation = Column(Text, default="")
 
+class ModelArtifact(Base):
+    __tablename__ = "models"
+    __table_args__ = (UniqueConstraint("user_id", "sensor_type"),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    sensor_type = Column(String(120), nullable=False, default="")  # "" => all sensor types
+    trained_on = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Float, default=lambda: time.time())
+    blob = Column(LargeBinary, nullable=False)
+
+class Rollup(Base):
+    __tablename__ = "rollups"
+    __table_args__ = (
+        UniqueConstraint("sensor_id", "resolution", "bucket"),
+        Index("ix_rollups_user_res_bucket", "user_id", "resolution", "bucket"),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    sensor_id = Column(Integer, ForeignKey("sensors.id"), nullable=False)
+    resolution = Column(Integer, nullable=False)  # bucket width in seconds
+    bucket = Column(Float, nullable=False)  # bucket start
+    count = Column(Integer, nullable=False, default=0)
+    sum = Column(Float, nullable=False, default=0.0)  # v1+v2+v3 summed over the bucket
+    min = Column(Float, nullable=False)  # smallest single-phase value
+    max = Column(Float, nullable=False)  # largest single-phase value
+    last_ts = Column(Float, nullable=False)
+    last_v1 = Column(Float, nullable=False)
+    last_v2 = Column(Float, nullable=False)
+    last_v3 = Column(Float, nullable=False)
+
+
+class SensorState(Base):
+    """Online detector state for one sensor (see streaming.py)."""
+    __tablename__ = "sensor_states"
+    sensor_id = Column(Integer, ForeignKey("sensors.id"), primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    n = Column(Integer, nullable=False, default=0)
+    state = Column(LargeBinary, nullable=False)
+    updated_at = Column(Float, default=lambda: time.time())
+
+class ColdChunk(Base):
+    """A block of compacted readings for one sensor, stored as .npy files (see coldstore.py)."""
+    __tablename__ = "cold_chunks"
+    __table_args__ = (Index("ix_cold_chunks_user_sensor_tmax", "user_id", "sensor_id", "t_max"),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    sensor_id = Column(Integer, ForeignKey("sensors.id"), nullable=False)
+    n = Column(Integer, nullable=False)
+    t_min = Column(Float, nullable=False)
+    t_max = Column(Float, nullable=False)
+    id_first = Column(Integer, nullable=False)  # readings.id of the first row; the rest are delta-encoded
+    path = Column(String(512), nullable=False)  # relative to COLD_DIR, without the .ts/.id/.v suffix
+    created_at = Column(Float, default=lambda: time.time())
+
+class IngestBatch(Base):
+    """Response of an ingest request sent with an idempotency key, replayed on retries."""
+    __tablename__ = "ingest_batches"
+    __table_args__ = (UniqueConstraint("user_id", "key"),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    key = Column(String(128), nullable=False)
+    sensor_id = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(Float, default=lambda: time.time(), index=True)
+
+class IngestOutbox(Base):
+    """An accepted ingest batch waiting for the outbox worker (`api/outbox.py`)."""
+    __tablename__ = "ingest_outbox"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    sensor_id = Column(Integer, nullable=False)
+    n = Column(Integer, nullable=False)
+    rows = Column(LargeBinary, nullable=False)  # little-endian float64 (timestamp, v1, v2, v3, stamped)
+    received_at = Column(Float, default=lambda: time.time(), nullable=False)
+    claimed_until = Column(Float, nullable=False, default=0.0, index=True)  # lease held by a draining worker
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+
+class SchemaMeta(Base):
+    __tablename__ = "schema_meta"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+# Bump when tables or indexes change so existing databases migrate on next start
+SCHEMA_VERSION = 6
+# Databases older than this predate the unique readings index and rollups. Deduping
+# readings and rebuilding rollups scans all history, so when they hold readings they
+# migrate only through `python api/db.py`, never on the request path
+OFFLINE_MIGRATION_BELOW = 4
+# Single-column indexes from earlier versions. Every query is scoped by user or sensor
+# and served by the composite indexes above, while each extra B-tree slows down ingest
+OBSOLETE_INDEXES = ("ix_readings_user_id", "ix_readings_sensor_id", "ix_readings_timestamp",
+                    "ix_anomalies_user_id", "ix_anomalies_sensor_id", "ix_anomalies_timestamp")
+_schema_ok = False
+_schema_lock = threading.Lock()
+log = logging.getLogger(__name__)
+
+
+def _schema_version() -> Optional[int]:
+    try:
+        with SessionLocal() as s:
+            return s.query(SchemaMeta.version).filter_by(id=1).scalar()
+    except Exception:
+        return None  # fresh database: no schema_meta table yet
+
+
+def _has_readings() -> bool:
+    if not inspect(engine).has_table("readings"):
+        return False
+    with SessionLocal() as s:
+        return s.execute(text("SELECT 1 FROM readings LIMIT 1")).first() is not None
+
 
 def init_db():
+    """Create missing tables and indexes, dedupe and backfill as needed, then record
+    SCHEMA_VERSION (`python api/db.py`)."""
+    current = _schema_version()
     Base.metadata.create_all(bind=engine)
+    _dedupe_readings()
+    # create_all skips existing tables, so add indexes introduced after a table was created
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    # rollups may miss readings older than them or count duplicates; nothing to do on a
+    # fresh database, where this also skips importing NumPy
+    if (current is None or current < OFFLINE_MIGRATION_BELOW) and _has_readings():
+        from rollups import rebuild_rollups
+        rebuild_rollups()
+    # only now: a version recorded before the backfill commits would skip it for good
+    with SessionLocal() as s:
+        s.query(SchemaMeta).delete()
+        s.add(SchemaMeta(id=1, version=SCHEMA_VERSION))
+        s.commit()
+
+
+def _dedupe_readings() -> int:
+    """Drop duplicate (sensor_id, timestamp) readings, keeping the first, before the
+    unique index is created on a database that predates it."""
+    if "uq_readings_sensor_ts" in {ix["name"] for ix in inspect(engine).get_indexes("readings")}:
+        return 0
+    with write_session() as s:
+        return s.execute(text(
+            "DELETE FROM readings WHERE id NOT IN (SELECT MIN(id) FROM readings GROUP BY sensor_id, timestamp)"
+        )).rowcount
+
+
+def ensure_schema() -> None:
+    """Migrate once if the database is older than this code; otherwise a single SELECT per process.
+
+    Runs on the request path, so a migration that has to scan history is only
+    reported; new tables are still created so the routes using them work.
+    """
+    global _schema_ok
+    if _schema_ok:
+        return
+    with _schema_lock:
+        if _schema_ok:
+            return
+        current = _schema_version()
+        if current != SCHEMA_VERSION:
+            if (current is None or current < OFFLINE_MIGRATION_BELOW) and _has_readings():
+                Base.metadata.create_all(bind=engine)
+                log.warning("database at schema version %s, code at %s: run `python api/db.py` to dedupe "
+                            "readings, build the unique index and backfill rollups", current or 0, SCHEMA_VERSION)
+            else:
+                init_db()
+        _schema_ok = True
 
 
 def get_session() -> Session:
     return SessionLocal()
 
+
+@contextmanager
+def write_session() -> Iterator[Session]:
+    """One write transaction for a whole batch: commits on success, rolls back on error.
+
+    SQLite has a single writer, so writers in this process queue on a lock rather
+    than spinning in the busy handler; busy_timeout covers other processes.
+    """
+    with _write_lock, WriteSessionLocal() as s:
+        try:
+            yield s
+            with timed("commit"):
+                s.commit()
+        except Exception:
+            s.rollback()
+            raise
+
+
+def bulk_insert(s: Session, table, columns: dict) -> None:
+    """Plain multi-row INSERT from column name -> equal-length lists, in the caller's transaction.
+
+    No conflict handling or RETURNING. On SQLite the rows go straight to the driver's
+    executemany, skipping SQLAlchemy's per-row parameter processing.
+    """
+    names = list(columns)
+    rows = list(zip(*columns.values()))
+    if not rows:
+        return
+    if s.bind.dialect.name != "sqlite":
+        s.execute(table.insert(), [dict(zip(names, r)) for r in rows])
+        return
+    sql = f"INSERT INTO {table.name} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+    s.connection().exec_driver_sql(sql, rows)
+
+
+if __name__ == "__main__":
+    init_db()
+    print(f"schema at version {SCHEMA_VERSION} on {engine.url.render_as_string(hide_password=True)}")
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+from typing import Iterator, Optional
+from sqlalchemy import func
+from db import get_session, Anomaly, Sensor
+
+# A serverless function is billed while a stream is open and wakes only for its own
+# writes, so there each connection answers once and closes: EventSource then polls
+# every SSE_RETRY_SECONDS, resuming from Last-Event-ID. Long-lived servers hold the
+# stream open, woken by AnomalyNotifier, and read the table every SSE_POLL_SECONDS
+# for writes from other processes
+SERVERLESS = bool(os.environ.get("VERCEL") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+SSE_MAX_SECONDS = float(os.environ.get("SSE_MAX_SECONDS", 0 if SERVERLESS else 300))
+SSE_POLL_SECONDS = float(os.environ.get("SSE_POLL_SECONDS", 30))
+SSE_RETRY_SECONDS = float(os.environ.get("SSE_RETRY_SECONDS", 5))
+SSE_HEARTBEAT_SECONDS = 15.0
+SSE_MAX_BACKLOG = 200
+SSE_BATCH = 100
+
+
+class AnomalyNotifier:
+    """Wakes streams on this instance as soon as anomalies are written; streams
+    still poll the table so writes from other instances are picked up too."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+
+    def version(self, user_id: int) -> int:
+        with self._cond:
+            return self._versions.get(user_id, 0)
+
+    def notify(self, user_id: int) -> None:
+        with self._cond:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._cond.notify_all()
+
+    def wait(self, user_id: int, version: int, timeout: float) -> int:
+        with self._cond:
+            self._cond.wait_for(lambda: self._versions.get(user_id, 0) != version, timeout)
+            return self._versions.get(user_id, 0)
+
+
+notifier = AnomalyNotifier()
+
+
+def latest_anomaly_id(user_id: int, backlog: int = 0) -> int:
+    """Id after which the user's newest `backlog` anomalies follow (their latest id for 0)."""
+    with get_session() as s:
+        if not backlog:
+            return s.query(func.max(Anomaly.id)).filter(Anomaly.user_id == user_id).scalar() or 0
+        row = (s.query(Anomaly.id).filter(Anomaly.user_id == user_id)
+               .order_by(Anomaly.id.desc()).offset(backlog).limit(1).first())
+        return row[0] if row else 0
+
+
+def _anomalies_after(user_id: int, after_id: int):
+    with get_session() as s:
+        return (
+            s.query(Anomaly.id, Anomaly.timestamp, Anomaly.score, Anomaly.explanation, Anomaly.sensor_id, Sensor.name, Sensor.room)
+            .outerjoin(Sensor, Anomaly.sensor_id == Sensor.id)
+            .filter(Anomaly.user_id == user_id, Anomaly.id > after_id)
+            .order_by(Anomaly.id)
+            .limit(SSE_BATCH)
+            .all()
+        )
+
+
+def anomaly_events(user_id: int, last_id: Optional[int] = None, max_seconds: float = SSE_MAX_SECONDS,
+                   backlog: int = 0) -> Iterator[str]:
+    """Server-Sent Events for anomalies with id > last_id (default: the newest `backlog`, then new ones)."""
+    if last_id is None:
+        last_id = latest_anomaly_id(user_id, min(backlog, SSE_MAX_BACKLOG))
+    deadline = time.monotonic() + max_seconds
+    beat = time.monotonic()
+    version = notifier.version(user_id)
+    # An `id:` field sets EventSource's Last-Event-ID even without data, so a stream
+    # that closes before any anomaly still resumes from here on reconnect
+    yield f"retry: {int(SSE_RETRY_SECONDS * 1000)}\nid: {last_id}\n\n"
+    read = True
+    next_poll = 0.0
+    while True:
+        if read:
+            rows = _anomalies_after(user_id, last_id)
+            for aid, ts, score, explanation, sensor_id, name, room in rows:
+                data = {"id": aid, "timestamp": ts, "score": score, "explanation": explanation,
+                        "sensor_id": sensor_id, "sensor_name": name, "room": room}
+                yield f"id: {aid}\nevent: anomaly\ndata: {json.dumps(data)}\n\n"
+                last_id = aid
+            if len(rows) == SSE_BATCH:
+                continue
+            next_poll = time.monotonic() + SSE_POLL_SECONDS
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if now - beat >= SSE_HEARTBEAT_SECONDS:
+            beat = now
+            yield f"id: {last_id}\n: keep-alive\n\n"
+        # the table is read again only when this process wrote for the user or the poll is due
+        wake = min(next_poll, deadline, beat + SSE_HEARTBEAT_SECONDS)
+        seen, version = version, notifier.wait(user_id, version, max(wake - now, 0.0))
+        read = version != seen or time.monotonic() >= next_poll
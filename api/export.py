@@ -0,0 +1,56 @@
+from typing import Iterable, Iterator, List, Optional
+import numpy as np
+from sqlalchemy import select
+from db import get_session, Reading
+from coldstore import cold_batches, cold_chunks, cold_end
+
+EXPORT_BATCH_ROWS = 8192
+
+
+def format_csv_batch(M: np.ndarray, row_fmt: str) -> str:
+    """Format a 2D numeric batch with one `%` operation; `%r` matches csv.writer's float output."""
+    if not M.shape[0]:
+        return ""
+    return (row_fmt * M.shape[0]) % tuple(M.ravel().tolist())
+
+
+def iter_csv(header: List[str], batches: Iterable[np.ndarray], row_fmt: str) -> Iterator[str]:
+    yield ",".join(header) + "\r\n"
+    for M in batches:
+        yield format_csv_batch(M, row_fmt)
+
+
+def array_batches(M: np.ndarray, batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[np.ndarray]:
+    for start in range(0, M.shape[0], batch_rows):
+        yield M[start:start + batch_rows]
+
+
+def _hot_query(user_id: int, sensor_id: Optional[int], since: Optional[float], until: Optional[float]):
+    q = select(Reading.timestamp, Reading.sensor_id, Reading.v1, Reading.v2, Reading.v3).where(Reading.user_id == user_id)
+    if sensor_id:
+        q = q.where(Reading.sensor_id == sensor_id)
+    if since is not None:
+        q = q.where(Reading.timestamp >= since)
+    if until is not None:
+        q = q.where(Reading.timestamp < until)
+    return q.order_by(Reading.timestamp)
+
+
+def reading_batches(user_id: int, sensor_id: Optional[int] = None, since: Optional[float] = None,
+                    until: Optional[float] = None, batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[np.ndarray]:
+    """Stream (timestamp, sensor_id, v1, v2, v3) batches through a server-side cursor,
+    merged in timestamp order with any compacted cold chunks in range."""
+    with get_session() as s:
+        chunks = cold_chunks(s, user_id, sensor_id, since, until)
+        if chunks:
+            def hot_range(lo, hi):
+                rows = s.execute(_hot_query(user_id, sensor_id, None if lo == -np.inf else lo, hi)).all()
+                return np.asarray(rows, dtype=float).reshape(-1, 5)
+            for M in cold_batches(chunks, since, until, hot_range):
+                yield from array_batches(M, batch_rows)
+            since = max(since, cold_end(chunks)) if since is not None else cold_end(chunks)
+            if until is not None and since >= until:
+                return
+        q = _hot_query(user_id, sensor_id, since, until).execution_options(stream_results=True, yield_per=batch_rows)
+        for part in s.execute(q).partitions():
+            yield np.asarray(part, dtype=float)
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from sqlalchemy import func
+from db import Anomaly, Sensor
+from events import notifier
+
+# Dashboards poll /api/anomalies; pages are cached per user and query and revalidated
+# with one indexed MAX(id) lookup, so an unchanged feed costs no join and no encoding.
+FEED_CACHE_BYTES = int(os.environ.get("FEED_CACHE_BYTES", 32 * 1024 * 1024))  # encoded pages across all users
+FEED_MAX_PAGE_BYTES = int(os.environ.get("FEED_MAX_PAGE_BYTES", 1024 * 1024))  # larger pages are served uncached
+# Sensor renames on another instance are only seen once an entry is this old
+FEED_CACHE_TTL = float(os.environ.get("FEED_CACHE_TTL", 60))
+
+ADVICE = {
+    'meter': "Check concurrent high-load appliances; consider staggering usage; inspect for shorts or overcurrent.",
+    'phase': "Investigate phase imbalance or wiring; redistribute loads across phases; check breaker health.",
+    'plug': "Unplug suspect device, inspect adapter/cable, avoid overloading multi-plugs.",
+}
+DEFAULT_ADVICE = "Verify wiring and recent load changes."
+
+
+def sensor_meta(sensor_id: Optional[int], name: Optional[str], sensor_type: Optional[str], room: Optional[str]) -> dict:
+    """The per-sensor fields every anomaly of that sensor carries in the feed."""
+    sensor_type = sensor_type or 'unknown'
+    return {
+        "sensor_id": sensor_id,
+        "sensor_name": name or f"Sensor {sensor_id or ''}".strip(),
+        "sensor_type": sensor_type,
+        "room": room or '-',
+        "advice": ADVICE.get(sensor_type, DEFAULT_ADVICE),
+    }
+
+
+class AnomalyFeed:
+    """LRU of encoded anomaly pages keyed by (user, query), bounded by their total size.
+
+    An entry is valid while the user's newest anomaly id, the notifier version
+    and the sensor generation are unchanged and it is younger than FEED_CACHE_TTL.
+    Writers on this instance bump the notifier (anomalies) or call
+    `sensors_changed` (sensor metadata); writes elsewhere show up in MAX(id).
+    """
+
+    def __init__(self, max_bytes: int = FEED_CACHE_BYTES, max_page_bytes: int = FEED_MAX_PAGE_BYTES,
+                 ttl: float = FEED_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_page_bytes = max_page_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pages: "OrderedDict[tuple, Tuple[tuple, float, str, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._sensors: Dict[int, Tuple[int, float, Dict[Optional[int], dict]]] = {}
+        self._sensor_gen: Dict[int, int] = {}
+
+    def sensors_changed(self, user_id: int) -> None:
+        with self._lock:
+            self._sensor_gen[user_id] = self._sensor_gen.get(user_id, 0) + 1
+            self._sensors.pop(user_id, None)
+
+    def stamp(self, s, user_id: int) -> tuple:
+        last = s.query(func.max(Anomaly.id)).filter(Anomaly.user_id == user_id).scalar() or 0
+        return last, notifier.version(user_id), self._sensor_gen.get(user_id, 0)
+
+    def sensors(self, s, user_id: int) -> Dict[Optional[int], dict]:
+        """Feed metadata for each of the user's sensors, loaded once per sensor generation."""
+        with self._lock:
+            gen = self._sensor_gen.get(user_id, 0)
+            hit = self._sensors.get(user_id)
+        if hit and hit[0] == gen and time.monotonic() - hit[1] < self.ttl:
+            return hit[2]
+        rows = s.query(Sensor.id, Sensor.name, Sensor.type, Sensor.room).filter(Sensor.user_id == user_id).all()
+        meta = {sid: sensor_meta(sid, name, typ, room) for sid, name, typ, room in rows}
+        with self._lock:
+            self._sensors[user_id] = (gen, time.monotonic(), meta)
+        return meta
+
+    def page(self, s, user_id: int, query: tuple, build: Callable[[], bytes]) -> Tuple[str, bytes]:
+        """(etag, body) for one page, from the cache or from `build()`.
+
+        The ETag hashes the body, so it is stable across instances and rebuilds.
+        """
+        key = (user_id,) + query
+        stamp = self.stamp(s, user_id)
+        with self._lock:
+            hit = self._pages.get(key)
+            if hit and hit[0] == stamp and time.monotonic() - hit[1] < self.ttl:
+                self._pages.move_to_end(key)
+                return hit[2], hit[3]
+        body = build()
+        etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old:
+                self._bytes -= len(old[3])
+            if len(body) <= self.max_page_bytes:
+                self._pages[key] = (stamp, time.monotonic(), etag, body)
+                self._bytes += len(body)
+                while self._bytes > self.max_bytes:
+                    self._bytes -= len(self._pages.popitem(last=False)[1][3])
+        return etag, body
+
+
+anomaly_feed = AnomalyFeed()
@@ -0,0 +1,108 @@
+import time
+from typing import Iterator, Optional, Sequence, Tuple
+import numpy as np
+
+# profile -> (mean, sd, surge multiplier, sag multiplier, default anomaly kinds)
+PROFILES = {
+    'baseline': (100.0, 10.0, 1.8, 0.6, ('surge',)),
+    'meter':    (120.0, 15.0, 1.7, 0.6, ('surge',)),
+    'phase':    (100.0, 10.0, 1.9, 0.6, ('phase',)),
+    'plug':     (20.0,  8.0,  2.5, 0.5, ('surge', 'sag')),
+}
+ANOMALY_KINDS = ('surge', 'sag', 'phase', 'dropout')
+
+
+def daily_curve(ts: np.ndarray) -> np.ndarray:
+    """Household load relative to the daily mean: overnight trough, morning and evening peaks."""
+    h = (ts % 86400.0) / 3600.0
+    c = 0.75 + 0.3 * np.exp(-0.5 * ((h - 8.0) / 1.5) ** 2) + 0.5 * np.exp(-0.5 * ((h - 19.5) / 2.5) ** 2)
+    return c / 0.9229  # 1 on average over a day
+
+
+def timestamps(n: int, end: float, interval: float = 1.0, jitter: float = 0.1, rng=None) -> np.ndarray:
+    """n increasing timestamps ending near `end`, `interval` apart with +-jitter*interval noise (jitter < 0.5)."""
+    ts = end - interval * np.arange(n - 1, -1, -1, dtype=float)
+    if jitter and rng is not None:
+        ts += rng.uniform(-jitter, jitter, size=n) * interval
+    return ts
+
+
+def inject(X: np.ndarray, idx: np.ndarray, kinds: np.ndarray, surge: float, sag: float, rng) -> None:
+    """Apply anomalies in place: `kinds[i]` at row `idx[i]`."""
+    for kind in ANOMALY_KINDS:
+        rows = idx[kinds == kind]
+        if not rows.shape[0]:
+            continue
+        if kind == 'surge':
+            X[rows] *= surge
+        elif kind == 'sag':
+            X[rows] *= sag
+        else:
+            phase = rng.integers(0, X.shape[1], size=rows.shape[0])
+            if kind == 'phase':
+                X[rows, phase] *= np.where(rng.random(rows.shape[0]) < 0.5, surge, sag)
+            else:  # dropout: one phase reads zero
+                X[rows, phase] = 0.0
+
+
+def _profile(profile: str, kinds: Optional[Sequence[str]]):
+    mu, sd, surge, sag, default_kinds = PROFILES.get(profile, PROFILES['baseline'])
+    kinds = tuple(kinds or default_kinds)
+    unknown = set(kinds) - set(ANOMALY_KINDS)
+    if unknown:
+        raise ValueError(f"unknown anomaly kind: {sorted(unknown)[0]}")
+    return mu, sd, surge, sag, kinds
+
+
+def _rows(ts: np.ndarray, k: int, rng, mu: float, sd: float, surge: float, sag: float, kinds: Tuple[str, ...],
+          daily: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """Values and labels for the timestamps `ts`, with `k` injected anomalies."""
+    n = ts.shape[0]
+    X = rng.normal(loc=mu, scale=sd, size=(n, 3))
+    if daily:
+        X *= daily_curve(ts)[:, None]
+    labels = np.zeros(n, dtype=int)
+    if k:
+        idx = rng.choice(n, size=k, replace=False)
+        inject(X, idx, rng.choice(np.array(kinds), size=k), surge, sag, rng)
+        labels[idx] = 1
+    return X, labels
+
+
+def generate(n: int, profile: str = 'baseline', anomaly_rate: float = 0.02, kinds: Optional[Sequence[str]] = None,
+             end: Optional[float] = None, interval: float = 1.0, jitter: float = 0.0, daily: bool = False,
+             anomalies: Optional[int] = None, seed: Optional[int] = 42) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """A labeled synthetic dataset in one pass: (timestamps, (n, 3) values, labels).
+
+    Without `end` timestamps run forward from now. `daily` shapes the mean with
+    `daily_curve`; `anomalies` overrides the count derived from `anomaly_rate`.
+    """
+    mu, sd, surge, sag, kinds = _profile(profile, kinds)
+    rng = np.random.default_rng(seed)
+    end = end if end is not None else time.time() + interval * (n - 1)
+    ts = timestamps(n, end, interval, jitter, rng)
+    k = min(n, anomalies if anomalies is not None else max(1, int(n * anomaly_rate)))
+    X, labels = _rows(ts, k, rng, mu, sd, surge, sag, kinds, daily)
+    return ts, X, labels
+
+
+def generate_batches(n: int, profile: str = 'baseline', anomaly_rate: float = 0.02, kinds: Optional[Sequence[str]] = None,
+                     end: Optional[float] = None, interval: float = 1.0, jitter: float = 0.0, daily: bool = False,
+                     seed: int = 42, batch_rows: int = 8192) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Like `generate`, as (timestamps, values, labels) slices of `batch_rows` so memory stays
+    bounded for any `n`. Each slice has its own seed derived from `seed`, and the anomalies
+    are spread across slices in proportion to their size. Bad arguments raise immediately.
+    """
+    mu, sd, surge, sag, kinds = _profile(profile, kinds)
+    end = end if end is not None else time.time() + interval * (n - 1)
+    k = min(n, max(1, int(n * anomaly_rate))) if n else 0
+
+    def batches():
+        for i, lo in enumerate(range(0, n, batch_rows)):
+            hi = min(n, lo + batch_rows)
+            rng = np.random.default_rng([seed, i])
+            ts = timestamps(hi - lo, end - interval * (n - hi), interval, jitter, rng)
+            X, labels = _rows(ts, hi * k // n - lo * k // n, rng, mu, sd, surge, sag, kinds, daily)
+            yield ts, X, labels
+
+    return batches()
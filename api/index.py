@@ -1,32 +1,88 @@
+import logging
+import os
 import time
 import io
 import csv
-import numpy as np
+import threading
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-from model import AnomalyDetector, get_sensor_data
-from db import init_db, get_session, User, Sensor, Reading, Anomaly
-from auth import require_auth, create_token, hash_password, verify_password
+from db import ensure_schema, get_session, write_session, User, Sensor, Reading, Anomaly, ColdChunk
+from auth import require_auth, create_token, hash_password, verify_password, needs_rehash
+from paging import MAX_PAGE, CursorError, decode_cursor, encode_cursor, keyset_page, time_filter
+from events import notifier, anomaly_events
+from metrics import init_app as init_metrics, timed
+from jsonio import make_provider
 
+# NumPy, scikit-learn and the modules built on them are imported inside the routes
+# that need them, so auth and listing endpoints cold-start without loading them.
 app = Flask(__name__)
+app.json = make_provider(app)
 CORS(app)
-init_db()
+log = logging.getLogger(__name__)
+# request/phase timings, Server-Timing and /api/metrics; registered before the other hooks
+init_metrics(app)
 
-# Single, reusable model instance for warm serverless invocations
-_detector = AnomalyDetector()
+@app.before_request
+def _schema():
+    # one cheap version check per process; migrations run only when it is stale
+    ensure_schema()
+
+DEMO_SEED_ROWS = 10_000
+MAX_SEED_ROWS = 5_000_000
+# /api/seed-demo is unauthenticated: `n` above the fixed demo size is honoured only with this set (load testing)
+ALLOW_LOAD_SEED = os.environ.get('ALLOW_LOAD_SEED', '').lower() in ('1', 'true', 'yes')
+# sync: detect and store inside the request; async: queue in the outbox and ack with 202
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync').lower()
+
+# Per-user models, created on first use and reused across warm serverless invocations
+_registry = None
+_retrainer = None
+_outbox_worker = None
+_models_lock = threading.Lock()
+
+def _models():
+    global _registry, _retrainer
+    if _registry is None:
+        with _models_lock:
+            if _registry is None:
+                from registry import ModelRegistry
+                from training import RetrainScheduler
+                _retrainer = RetrainScheduler(ModelRegistry())
+                _registry = _retrainer.registry
+    return _registry
+
+def _retrain():
+    _models()
+    return _retrainer
+
+def _outbox():
+    global _outbox_worker
+    if _outbox_worker is None:
+        registry, retrainer = _models(), _retrain()
+        with _models_lock:
+            if _outbox_worker is None:
+                from outbox import OutboxWorker
+                _outbox_worker = OutboxWorker(registry, retrainer)
+    return _outbox_worker
 
 @app.post('/api/safety-check')
 @require_auth
 def safety_check():
+    from model import get_sensor_data
+    from ingest import bulk_insert_anomalies
     try:
         data = get_sensor_data()
-        result = _detector.diagnose(data)
-        # persist anomalies with user association
         user_id = request.user["id"]
-        with get_session() as s:
-            for a in result.get("anomalies", []):
-                s.add(Anomaly(user_id=user_id, sensor_id=None, timestamp=a["timestamp"], score=a["score"], explanation=a["explanation"]))
-            s.commit()
+        with timed("model"):
+            result = _models().get(user_id).diagnose(data)
+        # persist anomalies with user association
+        with write_session() as s:
+            bulk_insert_anomalies(s, [
+                {"user_id": user_id, "sensor_id": None, "timestamp": a["timestamp"], "score": a["score"], "explanation": a["explanation"]}
+                for a in result.get("anomalies", [])
+            ])
+        if result.get("anomalies"):
+            notifier.notify(user_id)
         return jsonify({"ok": True, "result": result})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -34,9 +90,17 @@ def safety_check():
 @app.get('/api/generate-report')
 @require_auth
 def generate_report():
+    from model import get_sensor_data
+    from rollups import report_from_rollups
     try:
+        if (request.args.get('source') or '').lower() == 'stored':
+            # Report over the user's stored readings, read from the rollups
+            window = request.args.get('window', type=float, default=86400.0)
+            sensor_id = request.args.get('sensor_id', type=int)
+            with get_session() as s:
+                return jsonify(report_from_rollups(s, request.user['id'], window, sensor_id))
         data = get_sensor_data()
-        report = _detector.generate_report(data)
+        report = _models().get(request.user['id']).generate_report(data)
         return jsonify(report)
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -44,9 +108,10 @@ def generate_report():
 @app.get('/api/sample-series')
 @require_auth
 def sample_series():
+    from model import get_sensor_data
     try:
         data = get_sensor_data()
-        return jsonify({"data": data})
+        return _series_response({}, ["v1", "v2", "v3"], data)
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
@@ -54,11 +119,26 @@ def sample_series():
 @require_auth
 def view_alerts():
     try:
-        alerts = _detector.get_recent_alerts()
+        alerts = _models().get(request.user['id']).get_recent_alerts()
         return jsonify({"alerts": alerts})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.get('/api/alerts/stream')
+@require_auth(query_token=True)
+def stream_alerts():
+    # SSE push of new anomalies; resumes after Last-Event-ID (an anomalies.id)
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid_last_event_id"}), 400
+    backlog = request.args.get('backlog', type=int, default=0)
+    return Response(anomaly_events(request.user['id'], last_id, backlog=max(backlog, 0)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
 @app.post('/api/emergency-shutdown')
 @require_auth
 def emergency_shutdown():
@@ -82,7 +162,10 @@ def signup():
         with get_session() as s:
             if s.query(User).filter_by(email=email).first():
                 return jsonify({"ok": False, "error": "email_taken"}), 400
-            u = User(email=email, password_hash=hash_password(password))
+        # hash outside the session so the KDF does not hold a pooled connection
+        password_hash = hash_password(password)
+        with get_session() as s:
+            u = User(email=email, password_hash=password_hash)
             s.add(u); s.commit(); s.refresh(u)
             token = create_token(u.id, u.email)
             return jsonify({"ok": True, "token": token})
@@ -96,11 +179,20 @@ def login():
         email = (body.get('email') or '').strip().lower()
         password = body.get('password') or ''
         with get_session() as s:
-            u = s.query(User).filter_by(email=email).first()
-            if not u or not verify_password(password, u.password_hash):
-                return jsonify({"ok": False, "error": "invalid_login"}), 401
-            token = create_token(u.id, u.email)
-            return jsonify({"ok": True, "token": token})
+            u = s.query(User.id, User.email, User.password_hash).filter_by(email=email).first()
+        # verify and rehash outside the session so the KDF does not hold a pooled connection
+        if not u or not verify_password(password, u.password_hash):
+            return jsonify({"ok": False, "error": "invalid_login"}), 401
+        if needs_rehash(u.password_hash):
+            # upgrade legacy sha256 (or outdated scrypt cost) hashes now that the password is known
+            try:
+                password_hash = hash_password(password)
+                with write_session() as s:
+                    s.query(User).filter_by(id=u.id, password_hash=u.password_hash).update({"password_hash": password_hash})
+            except Exception:
+                log.exception("password rehash for user %s failed", u.id)  # retried on the next login
+        token = create_token(u.id, u.email)
+        return jsonify({"ok": True, "token": token})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
@@ -122,8 +214,14 @@ def create_sensor():
     with get_session() as s:
         sensor = Sensor(user_id=request.user['id'], name=name, room=room, type=typ)
         s.add(sensor); s.commit(); s.refresh(sensor)
+        _sensors_changed(request.user['id'])
         return jsonify({"ok": True, "sensor": {"id": sensor.id, "name": sensor.name, "room": sensor.room, "type": sensor.type}})
 
+def _sensors_changed(user_id: int) -> None:
+    # sensor metadata is cached by the anomaly feed
+    from feed import anomaly_feed
+    anomaly_feed.sensors_changed(user_id)
+
 @app.get('/api/sensors')
 @require_auth
 def list_sensors():
@@ -134,134 +232,203 @@ def list_sensors():
 @app.post('/api/readings')
 @require_auth
 def add_readings():
-    body = request.get_json() or {}
-    sensor_id = int(body.get('sensor_id') or 0)
-    rows = body.get('data') or []
-    if not sensor_id or not isinstance(rows, list) or not rows:
+    import numpy as np
+    from sqlalchemy.exc import IntegrityError
+    from ingest import MAX_IDEMPOTENCY_KEY, PayloadError, SensorBatch, parse_json_payload, parse_binary_payload, find_batch, save_batch
+    # Accepts row-wise JSON (`data`), columnar JSON (`v1`/`v2`/`v3`) or packed
+    # little-endian float64 (timestamp, v1, v2, v3) records as application/octet-stream.
+    # Readings already stored for the sensor are skipped; a batch sent with an
+    # `Idempotency-Key` header (or `batch_id`) is applied once and its response replayed.
+    # With `async` the batch is queued in the outbox and acknowledged with 202.
+    user_id = request.user['id']
+    binary = request.mimetype == 'application/octet-stream'
+    body = {} if binary else (request.get_json(silent=True) or {})
+    key = request.headers.get('Idempotency-Key') or (request.args.get('batch_id') if binary else body.get('batch_id'))
+    key = str(key) if key else None
+    if key and len(key) > MAX_IDEMPOTENCY_KEY:
+        return jsonify({"ok": False, "error": "invalid_batch_id"}), 400
+    queued = _async_ingest(body)
+
+    def replay():
+        with get_session() as s:
+            stored = find_batch(s, user_id, key)
+        return stored and Response(stored, status=202 if queued else 200, mimetype='application/json',
+                                   headers={'Idempotent-Replayed': 'true'})
+
+    if key and (resp := replay()):
+        return resp
+    try:
+        if binary:
+            sensor_id = request.args.get('sensor_id', type=int) or 0
+            X, ts = parse_binary_payload(request.get_data())
+            stamped = np.zeros(ts.shape[0], dtype=bool)
+        else:
+            sensor_id = int(body.get('sensor_id') or 0)
+            X, ts, stamped = parse_json_payload(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e) if isinstance(e, PayloadError) else "missing_data"}), 400
+    if not sensor_id:
         return jsonify({"ok": False, "error": "missing_data"}), 400
-    ts_list = body.get('timestamps') or []
-    ts_buffer = []
-    anomalies = []
     with get_session() as s:
         # validate sensor ownership
-        sensor = s.query(Sensor).filter_by(id=sensor_id, user_id=request.user['id']).first()
+        sensor = s.query(Sensor).filter_by(id=sensor_id, user_id=user_id).first()
         if not sensor:
             return jsonify({"ok": False, "error": "sensor_not_found"}), 404
-        for i, vec in enumerate(rows):
-            v1, v2, v3 = map(float, vec[:3])
-            ts = float(ts_list[i]) if i < len(ts_list) else time.time()
-            ts_buffer.append(ts)
-            s.add(Reading(user_id=request.user['id'], sensor_id=sensor_id, timestamp=ts, v1=v1, v2=v2, v3=v3))
-        s.commit()
-        # diagnose batch (model-based)
-        result = _detector.diagnose(rows)
-        for a in result.get('anomalies', []):
-            rec = Anomaly(user_id=request.user['id'], sensor_id=sensor_id, timestamp=a.get('timestamp', time.time()), score=a['score'], explanation=a['explanation'])
-            s.add(rec)
-            anomalies.append({"timestamp": rec.timestamp, "score": rec.score, "explanation": rec.explanation})
-        # type-aware rule-based anomalies
-        type_mu_sigma = {
-            'meter': (120.0, 15.0, 3.0),  # (mu, sigma, z-threshold)
-            'phase': (100.0, 10.0, 2.5),
-            'plug':  (20.0,  8.0, 2.0),
-        }
-        mu, sigma, zthr = type_mu_sigma.get((sensor.type or 'meter').lower(), (100.0, 10.0, 3.0))
-        for i, vec in enumerate(rows):
-            v1, v2, v3 = map(float, vec[:3])
-            zs = [abs((v - mu) / max(1e-6, sigma)) for v in (v1, v2, v3)]
-            spike = max(v1, v2, v3) > mu * 1.6
-            dip = min(v1, v2, v3) < mu * 0.6
-            if spike or dip or any(z > zthr for z in zs):
-                rec = Anomaly(
-                    user_id=request.user['id'], sensor_id=sensor_id, timestamp=ts_buffer[i],
-                    score=float(max(zs)), explanation=f"Type-aware rule: {sensor.type} z={max(zs):.2f}"
-                )
-                s.add(rec)
-                anomalies.append({"timestamp": rec.timestamp, "score": rec.score, "explanation": rec.explanation})
-        s.commit()
-    return jsonify({"ok": True, "inserted": len(rows), "anomalies": anomalies})
+        sensor_type = sensor.type
+        if not queued:
+            batch = SensorBatch(user_id, sensor_id, sensor_type, X, ts, stamped)
+            batch.drop_stored(s)
+    try:
+        if queued:
+            from outbox import enqueue
+            with write_session() as s:
+                result = {"ok": True, "queued": int(ts.shape[0]), "batch": enqueue(s, user_id, sensor_id, X, ts, stamped)}
+                if key:
+                    save_batch(s, user_id, key, sensor_id, result)
+        else:
+            # score before taking the write lock; readings, rollups and anomalies land in one short transaction
+            batch.score(_models())
+            with write_session() as s:
+                inserted = batch.write(s)
+                result = {"ok": True, "inserted": inserted, "duplicates": batch.received - inserted, "anomalies": batch.anomalies()}
+                if key:
+                    save_batch(s, user_id, key, sensor_id, result)
+    except IntegrityError:
+        # the same idempotency key committed first; its transaction won
+        if key and (resp := replay()):
+            return resp
+        raise
+    if queued:
+        _outbox().kick()
+        return jsonify(result), 202
+    batch.remember()
+    if batch.records:
+        notifier.notify(user_id)
+    _retrain().note_ingest(user_id, inserted, sensor_type)
+    return jsonify(result)
+
+def _async_ingest(body: dict) -> bool:
+    flag = request.args.get('async') or body.get('async')
+    if flag is None:
+        return INGEST_MODE == 'async'
+    return str(flag).lower() in ('1', 'true', 'yes')
 
 @app.get('/api/readings')
 @require_auth
 def list_readings():
+    # Newest-first keyset pages; each page's data is returned oldest-first
     sensor_id = request.args.get('sensor_id', type=int)
     limit = request.args.get('limit', type=int, default=500)
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
     with get_session() as s:
-        q = s.query(Reading).filter_by(user_id=request.user['id'])
+        q = s.query(Reading.id, Reading.timestamp, Reading.v1, Reading.v2, Reading.v3, Reading.sensor_id).filter(Reading.user_id == request.user['id'])
         if sensor_id:
-            q = q.filter_by(sensor_id=sensor_id)
-        rows = q.order_by(Reading.timestamp.desc()).limit(limit).all()
-        out = [[r.v1, r.v2, r.v3, r.timestamp, r.sensor_id] for r in rows][::-1]
-        return jsonify({"ok": True, "data": out})
+            q = q.filter(Reading.sensor_id == sensor_id)
+        q = time_filter(q, Reading.timestamp, since, until)
+        try:
+            rows, next_cursor = keyset_page(q, Reading.timestamp, Reading.id, request.args.get('cursor'), limit)
+        except CursorError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        cold = s.query(ColdChunk.id).filter(ColdChunk.user_id == request.user['id'])
+        if sensor_id:
+            cold = cold.filter(ColdChunk.sensor_id == sensor_id)
+        if time_filter(cold, ColdChunk.t_max, since).first():
+            # older readings were compacted into cold chunks; merge them into the page
+            from coldstore import cold_chunks, cold_page, merge_page
+            chunks = cold_chunks(s, request.user['id'], sensor_id, since, until)
+            limit = max(1, min(limit, MAX_PAGE))
+            after = decode_cursor(request.args.get('cursor'))
+            rows, more = merge_page(rows, next_cursor is not None, cold_page(chunks, since, until, after, limit), limit)
+            next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if more else None
+        out = [[v1, v2, v3, ts, sid] for _id, ts, v1, v2, v3, sid in reversed(rows)]
+        return jsonify({"ok": True, "data": out, "next_cursor": next_cursor})
+
+def _series_response(meta: dict, columns: list, data, t0=None):
+    # JSON by default; packed float32 rows when the client prefers SERIES_MIMETYPE
+    from series import SERIES_MIMETYPE, pack_series
+    if request.accept_mimetypes.best_match(['application/json', SERIES_MIMETYPE]) != SERIES_MIMETYPE:
+        return jsonify({**meta, "columns": columns, "data": data})
+    headers = {"X-Series-Columns": ",".join(columns), "X-Series-Rows": str(len(data))}
+    if t0 is not None:
+        headers["X-Series-T0"] = repr(t0)
+    for k, v in meta.items():
+        if k not in ("ok", "method"):
+            headers["X-Series-" + k.replace("_", "-").title()] = repr(v)
+    with timed("serialize"):
+        body = pack_series(data, len(columns), t0)
+    return Response(body, mimetype=SERIES_MIMETYPE, headers=headers)
+
+@app.get('/api/series')
+@require_auth
+def reading_series():
+    from series import MAX_POINTS, BUCKET_COLUMNS, bucket_series, lttb_series
+    # Chart series reduced server-side to about `points` points over [since, until)
+    sensor_id = request.args.get('sensor_id', type=int)
+    until = request.args.get('until', type=float) or time.time()
+    since = request.args.get('since', type=float) or until - 86400
+    points = min(max(request.args.get('points', type=int, default=300), 3), MAX_POINTS)
+    method = (request.args.get('method') or 'buckets').lower()
+    phase = (request.args.get('phase') or 'total').lower()
+    if since >= until or method not in ('buckets', 'lttb') or phase not in ('total', 'v1', 'v2', 'v3'):
+        return jsonify({"ok": False, "error": "invalid_params"}), 400
+    with get_session() as s:
+        if method == 'lttb':
+            data = lttb_series(s, request.user['id'], sensor_id, since, until, points, phase)
+            return _series_response({"ok": True, "method": method}, ["t", "v1", "v2", "v3"], data, since)
+        width, data = bucket_series(s, request.user['id'], sensor_id, since, until, points)
+        return _series_response({"ok": True, "method": method, "bucket_width": width}, BUCKET_COLUMNS, data, since)
 
 @app.get('/api/anomalies')
 @require_auth
 def list_anomalies():
+    from feed import anomaly_feed, sensor_meta
+    # Pages are cached per user and query; If-None-Match with the last ETag gets a 304
+    user_id = request.user['id']
     limit = request.args.get('limit', type=int, default=100)
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    sensor_id = request.args.get('sensor_id', type=int)
+    cursor = request.args.get('cursor')
+    try:
+        decode_cursor(cursor)
+    except CursorError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     with get_session() as s:
-        rows = (
-            s.query(Anomaly, Sensor)
-            .outerjoin(Sensor, Anomaly.sensor_id == Sensor.id)
-            .filter(Anomaly.user_id == request.user['id'])
-            .order_by(Anomaly.timestamp.desc())
-            .limit(limit)
-            .all()
-        )
-        out = []
-        for a, sn in rows:
-            sensor_type = (sn.type if sn else None) or 'unknown'
-            room = (sn.room if sn else None) or '-'
-            name = (sn.name if sn else None) or f"Sensor {a.sensor_id or ''}".strip()
-            # quick advice
-            advice = ""
-            if sensor_type == 'meter':
-                advice = "Check concurrent high-load appliances; consider staggering usage; inspect for shorts or overcurrent."
-            elif sensor_type == 'phase':
-                advice = "Investigate phase imbalance or wiring; redistribute loads across phases; check breaker health."
-            elif sensor_type == 'plug':
-                advice = "Unplug suspect device, inspect adapter/cable, avoid overloading multi-plugs."
-            else:
-                advice = "Verify wiring and recent load changes." 
-            out.append({
-                "timestamp": a.timestamp,
-                "score": a.score,
-                "explanation": a.explanation,
-                "sensor_id": a.sensor_id,
-                "sensor_name": name,
-                "sensor_type": sensor_type,
-                "room": room,
-                "advice": advice,
-            })
-        return jsonify({"ok": True, "anomalies": out})
+        def build():
+            q = s.query(Anomaly.id, Anomaly.timestamp, Anomaly.score, Anomaly.explanation, Anomaly.sensor_id).filter(Anomaly.user_id == user_id)
+            if sensor_id:
+                q = q.filter(Anomaly.sensor_id == sensor_id)
+            q = time_filter(q, Anomaly.timestamp, since, until)
+            rows, next_cursor = keyset_page(q, Anomaly.timestamp, Anomaly.id, cursor, limit)
+            meta = anomaly_feed.sensors(s, user_id)
+            if any(r[4] is not None and r[4] not in meta for r in rows):
+                # a sensor added on another instance since the metadata was loaded
+                anomaly_feed.sensors_changed(user_id)
+                meta = anomaly_feed.sensors(s, user_id)
+            out = [{"timestamp": ts, "score": score, "explanation": explanation,
+                    **(meta.get(a_sensor_id) or sensor_meta(a_sensor_id, None, None, None))}
+                   for _id, ts, score, explanation, a_sensor_id in rows]
+            return app.json.dumps({"ok": True, "anomalies": out, "next_cursor": next_cursor}).encode()
+
+        etag, body = anomaly_feed.page(s, user_id, (limit, since, until, sensor_id, cursor), build)
+    resp = Response(body, mimetype='application/json', headers={'Cache-Control': 'private, no-cache'})
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 @app.get('/api/rooms-summary')
 @require_auth
 def rooms_summary():
-    # Aggregate recent readings by room
-    limit = request.args.get('limit', type=int, default=1000)
+    from rollups import rooms_from_rollups
+    # Aggregate readings by room over a trailing time window, from the rollups
+    window = request.args.get('window', type=float, default=86400.0)
     user_id = request.user['id']
     with get_session() as s:
         # Sensor counts per room
-        sensors = s.query(Sensor).filter_by(user_id=user_id).all()
         room_sensors = {}
-        for sn in sensors:
-            room_sensors.setdefault(sn.room, set()).add(sn.id)
-        # Recent readings joined with sensors
-        q = (
-            s.query(Reading, Sensor.room)
-            .join(Sensor, Reading.sensor_id == Sensor.id)
-            .filter(Reading.user_id == user_id)
-            .order_by(Reading.timestamp.desc())
-            .limit(limit)
-        )
-        rooms = {}
-        for r, room in q:
-            entry = rooms.setdefault(room, {"reading_count": 0, "total": 0.0, "last": [0.0,0.0,0.0], "last_ts": 0})
-            entry["reading_count"] += 1
-            entry["total"] += float(r.v1 + r.v2 + r.v3)
-            if r.timestamp > entry["last_ts"]:
-                entry["last_ts"] = r.timestamp
-                entry["last"] = [float(r.v1), float(r.v2), float(r.v3)]
+        for sid, room in s.query(Sensor.id, Sensor.room).filter_by(user_id=user_id):
+            room_sensors.setdefault(room, set()).add(sid)
+        rooms = rooms_from_rollups(s, user_id, window)
         out = []
         for room, data in rooms.items():
             out.append({
@@ -274,29 +441,60 @@ def rooms_summary():
             })
         # Include rooms with sensors but no readings yet
         for room in room_sensors.keys():
-            if not any(x["room"] == room for x in out):
+            if room not in rooms:
                 out.append({"room": room, "sensors": len(room_sensors[room]), "reading_count": 0, "total": 0.0, "last": [0,0,0], "last_ts": 0})
         # sort by sensors then room name
         out.sort(key=lambda x: (-x["sensors"], x["room"]))
-        return jsonify({"ok": True, "rooms": out})
+        return jsonify({"ok": True, "rooms": out, "window": window})
 
 @app.post('/api/train')
 @require_auth
 def train_model():
-    # Train model on user's historical readings
-    with get_session() as s:
-        rows = s.query(Reading).filter_by(user_id=request.user['id']).all()
-        data = [[r.v1, r.v2, r.v3] for r in rows]
-        if not data:
-            return jsonify({"ok": False, "error": "no_data"}), 400
-        _detector.fit_with_user_data(data)
-        return jsonify({"ok": True, "trained_on": len(data)})
+    from training import collect_training_set
+    # Train the user's model (optionally per sensor type) on a bounded sample of their
+    # readings, over all history or the last `window` seconds
+    body = request.get_json(silent=True) or {}
+    user_id = request.user['id']
+    sensor_type = (body.get('sensor_type') or request.args.get('sensor_type') or '').strip().lower() or None
+    window = body.get('window') or request.args.get('window', type=float)
+    window = float(window) if window else None
+    if body.get('background') or request.args.get('background'):
+        queued = _retrain().submit(user_id, sensor_type, window)
+        return jsonify({"ok": True, "queued": queued, "sensor_type": sensor_type}), 202
+    data, seen = collect_training_set(user_id, sensor_type, window)
+    if not data.shape[0]:
+        return jsonify({"ok": False, "error": "no_data"}), 400
+    with timed("model"):
+        _models().train(user_id, data, sensor_type)
+    return jsonify({"ok": True, "trained_on": int(data.shape[0]), "rows_seen": seen, "sensor_type": sensor_type})
+
+@app.post('/api/diagnose-sweep')
+@require_auth
+def diagnose_sweep():
+    from sweep import run_sweep, submit_sweep
+    # Re-score all of the user's stored readings (optionally the last `window` seconds)
+    # with their current models, fanned out per sensor
+    body = request.get_json(silent=True) or {}
+    user_id = request.user['id']
+    window = body.get('window') or request.args.get('window', type=float)
+    since = time.time() - float(window) if window else None
+    if body.get('background') or request.args.get('background'):
+        submit_sweep(_models(), user_id, since)
+        return jsonify({"ok": True, "queued": True}), 202
+    return jsonify({"ok": True, **run_sweep(_models(), user_id, since)})
 
 @app.post('/api/seed-demo')
 def seed_demo():
-    # Create a demo user, sensors, and 10k samples
+    # Create a demo user and sensors, then bulk-load 10k readings (`n` with ALLOW_LOAD_SEED)
+    # spread over the sensors, 30 s apart on a daily load curve and ending now
     try:
-        import numpy as np, random, time as _t
+        import random
+        from generators import generate
+        from ingest import append_readings, newest_stored
+        from rollups import append_rollups
+        total = DEMO_SEED_ROWS
+        if ALLOW_LOAD_SEED:
+            total = max(1, min(request.args.get('n', type=int, default=DEMO_SEED_ROWS), MAX_SEED_ROWS))
         email = 'demo@voltgaurd.local'
         with get_session() as s:
             u = s.query(User).filter_by(email=email).first()
@@ -309,77 +507,70 @@ def seed_demo():
                 room = random.choice(rooms)
                 existing = s.query(Sensor).filter_by(user_id=u.id, name=name).first()
                 if existing:
-                    sensors.append(existing)
+                    sensors.append(existing.id)
                 else:
                     sn = Sensor(user_id=u.id, name=name, room=room, type='meter')
-                    s.add(sn); s.commit(); s.refresh(sn); sensors.append(sn)
-            # Seed ~10k samples across sensors
-            rng = np.random.default_rng(123)
-            total = 10000
-            for sn in sensors:
-                for _ in range(total // len(sensors)):
-                    base = rng.normal(loc=100.0, scale=10.0, size=(1,3))[0]
-                    if rng.random() < 0.02:
-                        base *= 1.8
-                    s.add(Reading(user_id=u.id, sensor_id=sn.id, timestamp=_t.time(), v1=float(base[0]), v2=float(base[1]), v3=float(base[2])))
-            s.commit()
-            return jsonify({"ok": True, "demo_user": email})
+                    s.add(sn); s.commit(); s.refresh(sn); sensors.append(sn.id)
+            user_id = u.id
+        _sensors_changed(user_id)
+        now = time.time()
+        inserted = 0
+        for i, sensor_id in enumerate(sensors):
+            ts, X, _ = generate(total // len(sensors), 'baseline', end=now, interval=30.0, jitter=0.2, daily=True, seed=123 + i)
+            with write_session() as s:
+                # only rows past the sensor's newest reading: a re-seed extends the history up
+                # to now, and rows that cannot conflict skip the per-row ON CONFLICT/RETURNING path
+                newest = newest_stored(s, user_id, sensor_id)
+                if newest is not None:
+                    X, ts = X[ts > newest], ts[ts > newest]
+                append_readings(s, user_id, sensor_id, X, ts)
+                append_rollups(s, user_id, sensor_id, X, ts)
+            inserted += int(ts.shape[0])
+        return jsonify({"ok": True, "demo_user": email, "inserted": inserted})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 @app.get('/api/dataset.csv')
 def dataset_csv():
+    import numpy as np
+    from export import EXPORT_BATCH_ROWS, iter_csv
+    from generators import generate_batches
     # Generate a CSV dataset with anomalies for offline testing
     try:
         n = int(request.args.get('n', 10000))
         rate = float(request.args.get('anomaly_rate', 0.02))
         profile = (request.args.get('profile') or 'baseline').lower()  # baseline|meter|phase|plug
-        rng = np.random.default_rng(42)
-        if profile == 'meter':
-            mu, sd = 120.0, 15.0
-            X = rng.normal(loc=mu, scale=sd, size=(n, 3))
-            labels = np.zeros(n, dtype=int)
-            k = max(1, int(n * rate))
-            idx = rng.choice(n, size=k, replace=False)
-            X[idx] *= 1.7
-            labels[idx] = 1
-        elif profile == 'phase':
-            mu, sd = 100.0, 10.0
-            X = rng.normal(loc=mu, scale=sd, size=(n, 3))
-            # emphasize single-phase spikes/dips
-            labels = np.zeros(n, dtype=int)
-            for i in rng.integers(0, n, size=max(1,int(n*rate))):
-                phase = rng.integers(0,3)
-                mult = 1.9 if rng.random() < 0.5 else 0.6
-                X[i, phase] *= mult
-                labels[i] = 1
-        elif profile == 'plug':
-            mu, sd = 20.0, 8.0
-            X = rng.normal(loc=mu, scale=sd, size=(n, 3))
-            labels = np.zeros(n, dtype=int)
-            for i in rng.integers(0, n, size=max(1,int(n*rate))):
-                X[i, :] *= 2.5 if rng.random() < 0.5 else 0.5
-                labels[i] = 1
-        else:  # baseline
-            X = rng.normal(loc=100.0, scale=10.0, size=(n, 3))
-            labels = np.zeros(n, dtype=int)
-            k = max(1, int(n * rate))
-            idx = rng.choice(n, size=k, replace=False)
-            X[idx] *= 1.8
-            labels[idx] = 1
-        buf = io.StringIO()
-        w = csv.writer(buf)
-        w.writerow(['timestamp','v1','v2','v3','label','profile'])
-        ts0 = time.time()
-        for i in range(n):
-            w.writerow([ts0 + i, float(X[i,0]), float(X[i,1]), float(X[i,2]), int(labels[i]), profile])
-        out = buf.getvalue()
-        return Response(out, mimetype='text/csv', headers={
+        kinds = [k for k in (request.args.get('anomalies') or '').lower().split(',') if k] or None  # surge,sag,phase,dropout
+        interval = request.args.get('interval', type=float, default=1.0)
+        daily = request.args.get('daily', '').lower() in ('1', 'true', 'yes')
+        # generated and formatted a slice at a time, so memory does not grow with n
+        batches = generate_batches(n, profile, rate, kinds, interval=interval, daily=daily, batch_rows=EXPORT_BATCH_ROWS)
+        # profile is user-supplied: quote it like csv.writer would and escape it for `%`
+        cell = io.StringIO()
+        csv.writer(cell).writerow([profile])
+        row_fmt = '%r,%r,%r,%r,%d,' + cell.getvalue().rstrip('\r\n').replace('%', '%%') + '\r\n'
+        chunks = iter_csv(['timestamp','v1','v2','v3','label','profile'], (np.column_stack(b) for b in batches), row_fmt)
+        return Response(chunks, mimetype='text/csv', headers={
             'Content-Disposition': f'attachment; filename="voltgaurd_{profile}_{n}.csv"'
         })
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.get('/api/readings.csv')
+@require_auth
+def readings_csv():
+    from export import iter_csv, reading_batches
+    # Stream the user's stored readings without buffering the whole export
+    sensor_id = request.args.get('sensor_id', type=int)
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    batches = reading_batches(request.user['id'], sensor_id, since, until)
+    chunks = iter_csv(['timestamp','sensor_id','v1','v2','v3'], batches, '%r,%d,%r,%r,%r\r\n')
+    name = f"voltgaurd_readings_{sensor_id or 'all'}.csv"
+    return Response(chunks, mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
 # Vercel uses module-level app reference
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5000, debug=True)
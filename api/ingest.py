@@ -0,0 +1,276 @@
+import json
+import os
+import time
+from typing import Optional, Tuple
+import numpy as np
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from db import bulk_insert, ColdChunk, Reading, Anomaly, IngestBatch
+from metrics import timed
+from model import MODEL_EXPLANATION
+
+# Binary payloads are little-endian float64 records of (timestamp, v1, v2, v3)
+BINARY_DTYPE = np.dtype('<f8')
+BINARY_COLUMNS = 4
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+MAX_IDEMPOTENCY_KEY = 128
+STAMP_STEP = 1e-6  # spacing of server-assigned timestamps within a batch
+LOOKUP_CHUNK = 500  # timestamps per IN (...) lookup, under SQLite's bound-parameter limit
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def _fill_timestamps(n: int, ts_list) -> Tuple[np.ndarray, np.ndarray]:
+    # Rows without an explicit timestamp are stamped with the ingest time, 1 us
+    # apart so each keeps its own (sensor_id, timestamp); returns (ts, stamped mask)
+    ts = time.time() + np.arange(n) * STAMP_STEP
+    stamped = np.ones(n, dtype=bool)
+    if ts_list:
+        given = np.asarray(ts_list[:n], dtype=float)
+        if given.ndim != 1:
+            raise PayloadError("invalid_timestamps")
+        ts[:given.shape[0]] = given
+        stamped[:given.shape[0]] = False
+    return ts, stamped
+
+
+def parse_json_payload(body: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (X, ts, stamped) from a row-wise `data` or columnar `v1/v2/v3` JSON body;
+    `stamped` marks rows whose timestamp was assigned here."""
+    try:
+        if 'data' in body:
+            rows = body.get('data') or []
+            if not isinstance(rows, list) or not rows:
+                raise PayloadError("missing_data")
+            try:
+                X = np.asarray(rows, dtype=float)
+            except ValueError:
+                # ragged rows: keep the first three values of each, as before
+                X = np.asarray([list(r)[:3] for r in rows], dtype=float)
+            if X.ndim != 2 or X.shape[1] < 3:
+                raise PayloadError("invalid_data")
+            X = X[:, :3]
+        else:
+            cols = [body.get(k) for k in ('v1', 'v2', 'v3')]
+            if not all(isinstance(c, list) and c for c in cols):
+                raise PayloadError("missing_data")
+            if len({len(c) for c in cols}) != 1:
+                raise PayloadError("invalid_data")
+            X = np.column_stack([np.asarray(c, dtype=float) for c in cols])
+            if X.shape[1] != 3:
+                raise PayloadError("invalid_data")
+        ts, stamped = _fill_timestamps(X.shape[0], body.get('timestamps') or [])
+    except PayloadError:
+        raise
+    except (TypeError, ValueError):
+        raise PayloadError("invalid_data")
+    if not (np.isfinite(X).all() and np.isfinite(ts).all()):
+        raise PayloadError("invalid_data")
+    return np.ascontiguousarray(X), ts, stamped
+
+
+def parse_binary_payload(raw: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    record = BINARY_DTYPE.itemsize * BINARY_COLUMNS
+    if not raw:
+        raise PayloadError("missing_data")
+    if len(raw) % record:
+        raise PayloadError("invalid_data")
+    arr = np.frombuffer(raw, dtype=BINARY_DTYPE).reshape(-1, BINARY_COLUMNS)
+    if not np.isfinite(arr).all():
+        raise PayloadError("invalid_data")
+    return np.ascontiguousarray(arr[:, 1:]), arr[:, 0].copy()
+
+
+def unique_rows(ts: np.ndarray) -> np.ndarray:
+    """Mask keeping the first row for each timestamp in a batch."""
+    keep = np.zeros(ts.shape[0], dtype=bool)
+    keep[np.unique(ts, return_index=True)[1]] = True
+    return keep
+
+
+def restamp(s, sensor_id: int, ts: np.ndarray, stamped: np.ndarray) -> np.ndarray:
+    """Move server-assigned timestamps past any the sensor already has from that instant on.
+
+    Concurrent batches stamped within the same milliseconds would otherwise collide
+    and be dropped as duplicates; call inside the write transaction.
+    """
+    if not stamped.any():
+        return ts
+    first = float(ts[stamped].min())
+    last = s.execute(select(func.max(Reading.timestamp)).where(Reading.sensor_id == sensor_id, Reading.timestamp >= first)).scalar()
+    if last is None:
+        return ts
+    ts = ts.copy()
+    ts[stamped] += last + STAMP_STEP - first
+    return ts
+
+
+def stored_mask(s, user_id: int, sensor_id: int, ts: np.ndarray) -> np.ndarray:
+    """Rows of the batch whose (sensor_id, timestamp) is already stored, hot or in a cold chunk.
+
+    Looks up the batch's own timestamps on the unique index, so the cost follows the
+    batch rather than the history it spans; chunk files are only read for chunks
+    whose time range holds one of them.
+    """
+    from coldstore import cold_chunks, load_chunk
+    mask = np.zeros(ts.shape[0], dtype=bool)
+    if not ts.shape[0]:
+        return mask
+    values = np.unique(ts)
+    found = []
+    for i in range(0, values.shape[0], LOOKUP_CHUNK):
+        q = select(Reading.timestamp).where(Reading.sensor_id == sensor_id,
+                                            Reading.timestamp.in_(values[i:i + LOOKUP_CHUNK].tolist()))
+        found += s.execute(q).scalars().all()
+    mask |= np.isin(ts, np.asarray(found, dtype=float))
+    # the unique index only covers hot rows; compacted readings must be checked here
+    for chunk in cold_chunks(s, user_id, sensor_id, float(values[0]), np.nextafter(values[-1], np.inf)):
+        if np.searchsorted(values, chunk.t_max, side="right") > np.searchsorted(values, chunk.t_min, side="left"):
+            mask |= np.isin(ts, load_chunk(chunk)[0])
+    return mask
+
+
+def bulk_insert_readings(s, user_id: int, sensor_id: int, X: np.ndarray, ts: np.ndarray) -> np.ndarray:
+    """Insert a batch in one statement, skipping rows already stored for the sensor.
+
+    Returns a mask of the rows actually inserted.
+    """
+    if not ts.shape[0]:
+        return np.zeros(0, dtype=bool)
+    params = [
+        {"user_id": user_id, "sensor_id": sensor_id, "timestamp": t, "v1": a, "v2": b, "v3": c}
+        for t, (a, b, c) in zip(ts.tolist(), X.tolist())
+    ]
+    dialect = postgresql if s.bind.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(Reading).on_conflict_do_nothing(index_elements=[Reading.sensor_id, Reading.timestamp])
+    inserted = s.connection().execute(stmt.returning(Reading.timestamp), params).scalars().all()
+    if len(inserted) == ts.shape[0]:
+        return np.ones(ts.shape[0], dtype=bool)
+    return np.isin(ts, np.asarray(inserted, dtype=float))
+
+
+def newest_stored(s, user_id: int, sensor_id: int) -> Optional[float]:
+    """Latest timestamp the sensor has, hot or compacted."""
+    hot = s.execute(select(func.max(Reading.timestamp)).where(Reading.sensor_id == sensor_id)).scalar()
+    cold = s.execute(select(func.max(ColdChunk.t_max)).where(ColdChunk.user_id == user_id,
+                                                             ColdChunk.sensor_id == sensor_id)).scalar()
+    return max((t for t in (hot, cold) if t is not None), default=None)
+
+
+def append_readings(s, user_id: int, sensor_id: int, X: np.ndarray, ts: np.ndarray) -> None:
+    """Insert rows newer than newest_stored() for the sensor, which cannot conflict, in one
+    plain bulk insert; used for seeding, where the per-row RETURNING path dominates."""
+    n = ts.shape[0]
+    bulk_insert(s, Reading.__table__, {"user_id": [user_id] * n, "sensor_id": [sensor_id] * n, "timestamp": ts.tolist(),
+                                       "v1": X[:, 0].tolist(), "v2": X[:, 1].tolist(), "v3": X[:, 2].tolist()})
+
+
+def anomaly_records(user_id: int, sensor_id: Optional[int], ts: np.ndarray, model_mask: np.ndarray, model_scores: np.ndarray,
+                    rule_mask: np.ndarray, rule_scores: np.ndarray, rule_kind: np.ndarray, sensor_type: Optional[str]) -> list:
+    """One anomaly per flagged reading, in reading order.
+
+    Readings flagged by both the model and the sensor baseline are merged into a
+    single record carrying the baseline z-score and both explanations.
+    """
+    idx = np.flatnonzero(model_mask | rule_mask)
+    if not idx.shape[0]:
+        return []
+    m, r = model_mask[idx], rule_mask[idx]
+    score = np.where(r, rule_scores[idx], model_scores[idx])
+    rule_text = [f"Sensor baseline ({k}): {sensor_type} z={z:.2f}" for k, z in zip(rule_kind[idx].tolist(), rule_scores[idx].tolist())]
+    explanations = [
+        f"{MODEL_EXPLANATION} {rt}" if both else (rt if only_rule else MODEL_EXPLANATION)
+        for both, only_rule, rt in zip((m & r).tolist(), r.tolist(), rule_text)
+    ]
+    return [
+        {"user_id": user_id, "sensor_id": sensor_id, "timestamp": t, "score": sc, "explanation": ex}
+        for t, sc, ex in zip(ts[idx].tolist(), score.tolist(), explanations)
+    ]
+
+
+def bulk_insert_anomalies(s, records) -> None:
+    if records:
+        s.execute(insert(Anomaly), records)
+
+
+def find_batch(s, user_id: int, key: str) -> Optional[str]:
+    """Stored response for an idempotency key still within IDEMPOTENCY_TTL."""
+    row = s.execute(select(IngestBatch.response).where(
+        IngestBatch.user_id == user_id, IngestBatch.key == key,
+        IngestBatch.created_at >= time.time() - IDEMPOTENCY_TTL)).first()
+    return row[0] if row else None
+
+
+def save_batch(s, user_id: int, key: str, sensor_id: int, response: dict) -> None:
+    """Record the response for `key` (a concurrent duplicate fails the transaction) and expire old keys."""
+    now = time.time()
+    s.execute(delete(IngestBatch).where(IngestBatch.created_at < now - IDEMPOTENCY_TTL))
+    s.execute(insert(IngestBatch), [{"user_id": user_id, "key": key, "sensor_id": sensor_id,
+                                      "response": json.dumps(response), "created_at": now}])
+
+
+class SensorBatch:
+    """One sensor's rows on their way into storage, shared by synchronous ingest
+    and the outbox worker: drop duplicates, score, then write in the caller's
+    transaction."""
+
+    def __init__(self, user_id: int, sensor_id: int, sensor_type: Optional[str], X: np.ndarray, ts: np.ndarray,
+                 stamped: np.ndarray):
+        self.user_id, self.sensor_id, self.sensor_type = user_id, sensor_id, sensor_type
+        self.received = int(ts.shape[0])
+        keep = unique_rows(ts)
+        self.X, self.ts, self.stamped = X[keep], ts[keep], stamped[keep]
+        self.detector = None
+        self.records = []
+        n = self.ts.shape[0]
+        self._scores = (np.zeros(n), np.zeros(n, dtype=bool))
+
+    def drop_stored(self, s) -> None:
+        """Skip rows already stored, so retries never reach the detectors."""
+        # server-stamped rows are new by construction, and leaving them out keeps
+        # a short `timestamps` list from widening the lookup to the present
+        fresh = self.stamped.copy()
+        fresh[~self.stamped] = ~stored_mask(s, self.user_id, self.sensor_id, self.ts[~self.stamped])
+        self.X, self.ts, self.stamped = self.X[fresh], self.ts[fresh], self.stamped[fresh]
+        self._scores = tuple(a[fresh] for a in self._scores)
+
+    def score(self, registry) -> None:
+        """IsolationForest scores; runs outside the write lock."""
+        if not self.ts.shape[0]:
+            return
+        with timed("model"):
+            self.detector = registry.get(self.user_id, self.sensor_type)
+            self._scores = self.detector.score_batch(self.X)
+
+    def write(self, s) -> int:
+        """Readings, rollups, anomalies and detector state; returns rows inserted."""
+        from rollups import update_rollups
+        from streaming import load_detector, save_detector
+        self.ts = restamp(s, self.sensor_id, self.ts, self.stamped)
+        ins = bulk_insert_readings(s, self.user_id, self.sensor_id, self.X, self.ts)
+        # normally all of them; fewer if a concurrent request stored some first
+        self.X, self.ts = self.X[ins], self.ts[ins]
+        model_scores, model_mask = self._scores = tuple(a[ins] for a in self._scores)
+        if not self.ts.shape[0]:
+            return 0
+        # The online baseline is sequential state: load, advance and save it inside
+        # the write transaction so concurrent batches for a sensor apply in turn
+        with timed("model"):
+            online = load_detector(s, self.sensor_id, self.sensor_type)
+            rule_mask, rule_scores, kind = online.score(self.X)
+        self.records = anomaly_records(self.user_id, self.sensor_id, self.ts, model_mask, model_scores,
+                                       rule_mask, rule_scores, kind, self.sensor_type)
+        update_rollups(s, self.user_id, self.sensor_id, self.X, self.ts)
+        bulk_insert_anomalies(s, self.records)
+        save_detector(s, self.sensor_id, self.user_id, online)
+        return int(self.ts.shape[0])
+
+    def remember(self) -> None:
+        """Add model outliers to the in-memory recent alerts, once the write has committed."""
+        if self.detector is not None:
+            self.detector.remember(self._scores[1], self._scores[0], self.ts)
+
+    def anomalies(self) -> list:
+        return [{"timestamp": r["timestamp"], "score": r["score"], "explanation": r["explanation"]} for r in self.records]
@@ -0,0 +1,52 @@
+import os
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from metrics import timed
+
+# auto: orjson when installed, else the stdlib provider; "std" forces the stdlib
+JSON_PROVIDER = os.environ.get("JSON_PROVIDER", "auto").lower()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's stdlib provider, with encoding charged to the "serialize" phase."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        with timed("serialize"):
+            return super().dumps(obj, **kwargs)
+
+
+class OrJSONProvider(JSONProvider):
+    """orjson encodes NumPy arrays and scalars natively and writes bytes straight
+    into the response; anything it cannot encode goes through Flask's `default`."""
+
+    def __init__(self, app: Flask):
+        import orjson
+        super().__init__(app)
+        self._orjson = orjson
+        self._options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def _encode(self, obj) -> bytes:
+        with timed("serialize"):
+            return self._orjson.dumps(obj, default=self.default, option=self._options)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:  # indent/sort_keys etc. are stdlib-only
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return self._orjson.loads(s) if not kwargs else super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._encode(obj), mimetype=self.mimetype)
+
+
+def make_provider(app: Flask) -> JSONProvider:
+    if JSON_PROVIDER != "std":
+        try:
+            return OrJSONProvider(app)
+        except ImportError:
+            if JSON_PROVIDER == "orjson":
+                raise
+    return JSONProvider(app)
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+from flask import Flask, g, has_request_context, request
+
+# Upper bounds in seconds; every histogram is these counters plus a sum, so memory
+# is fixed per (route, phase) no matter how many requests are observed
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # when set, /api/metrics requires it as a bearer token
+
+REQUEST_SECONDS = "voltguard_request_seconds"
+PHASE_SECONDS = "voltguard_phase_seconds"
+_HELP = {
+    REQUEST_SECONDS: "Request handling time by route, method and status.",
+    PHASE_SECONDS: "Time per request spent in one phase (auth, db, commit, model, serialize).",
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect_left(BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._hists: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = Histogram()
+            h.observe(value)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        with self._lock:
+            items = sorted((k, list(h.counts), h.sum, h.count) for k, h in self._hists.items())
+        out, seen = [], set()
+        for (name, labels), counts, total, n in items:
+            if name not in seen:
+                seen.add(name)
+                out += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+            lbl = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            sep = "," if lbl else ""
+            cum = 0
+            for le, c in zip(BUCKETS + (float("inf"),), counts):
+                cum += c
+                out.append(f'{name}_bucket{{{lbl}{sep}le="{"+Inf" if le == float("inf") else le}"}} {cum}')
+            out.append(f"{name}_sum{{{lbl}}} {total!r}")
+            out.append(f"{name}_count{{{lbl}}} {n}")
+        return "\n".join(out) + "\n"
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def add_phase(phase: str, seconds: float) -> None:
+    """Charge time to a phase of the current request, or directly to the histogram
+    (route "-") for work outside a request such as background retraining."""
+    timings = g.get("_phase_timings") if has_request_context() else None
+    if timings is None:
+        registry.observe(PHASE_SECONDS, seconds, route="-", phase=phase)
+    else:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - t)
+
+
+def instrument_engine(engine) -> None:
+    """Charge SQL statement execution to the "db" phase."""
+    from sqlalchemy import event
+
+    # The start time lives on the execution context, which is discarded with the
+    # statement, so a statement that raises (no after_cursor_execute) leaves nothing behind
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is not None:
+            add_phase("db", time.perf_counter() - start)
+
+
+def init_app(app: Flask) -> None:
+    """Time every request, add a Server-Timing header and serve /api/metrics.
+
+    Register before other hooks so their time is included in `total`.
+    """
+
+    @app.before_request
+    def _start():
+        g._request_start = time.perf_counter()
+        g._phase_timings = {}
+
+    @app.after_request
+    def _finish(resp):
+        timings = g.pop("_phase_timings", None)
+        if timings is None:
+            return resp
+        total = time.perf_counter() - g._request_start
+        route = _route()
+        registry.observe(REQUEST_SECONDS, total, route=route, method=request.method, status=str(resp.status_code))
+        for phase, secs in timings.items():
+            registry.observe(PHASE_SECONDS, secs, route=route, phase=phase)
+        parts = [f"{p};dur={s * 1000:.2f}" for p, s in timings.items()] + [f"total;dur={total * 1000:.2f}"]
+        resp.headers["Server-Timing"] = ", ".join(parts)
+        return resp
+
+    @app.get("/api/metrics")
+    def metrics():
+        if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+            return {"ok": False, "error": "unauthorized"}, 401
+        return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
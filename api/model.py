@@ -1,32 +1,52 @@
 import time
-from typing import List
+from collections import deque
+from typing import TYPE_CHECKING, List, Optional
 import numpy as np
-from sklearn.ensemble import IsolationForest
+
+if TYPE_CHECKING:
+    from sklearn.ensemble import IsolationForest
+
+MAX_ALERTS = 200
+MODEL_EXPLANATION = "IsolationForest indicates outlier compared to baseline."
 
 class AnomalyDetector:
-    def __init__(self, baseline_samples: int = 10000, features: int = 3, random_state: int = 42):
-        # Train a stronger baseline model on synthetic normal usage
-        rng = np.random.default_rng(random_state)
-        baseline = rng.normal(loc=100.0, scale=10.0, size=(baseline_samples, features))
-        self.model = IsolationForest(n_estimators=200, contamination=0.02, random_state=random_state)
-        self.model.fit(baseline)
-        self._alerts = []
-
-    def diagnose(self, data: List[List[float]]):
-        X = np.array(data, dtype=float)
-        scores = -self.model.score_samples(X)  # higher => more anomalous
-        preds = self.model.predict(X)  # -1 => anomaly
-        anomalies = []
-        for i, (s, p) in enumerate(zip(scores, preds)):
-            if p == -1:
-                alert = {
-                    "timestamp": time.time(),
-                    "index": i,
-                    "score": float(s),
-                    "explanation": "IsolationForest indicates outlier compared to baseline.",
-                }
-                anomalies.append(alert)
-                self._alerts.append(alert)
+    def __init__(self, baseline_samples: int = 10000, features: int = 3, random_state: int = 42, model: Optional["IsolationForest"] = None):
+        if model is None:
+            # sklearn is imported only when a model is trained, so get_sensor_data stays cheap
+            from sklearn.ensemble import IsolationForest
+            # Train a stronger baseline model on synthetic normal usage
+            rng = np.random.default_rng(random_state)
+            baseline = rng.normal(loc=100.0, scale=10.0, size=(baseline_samples, features))
+            model = IsolationForest(n_estimators=200, contamination=0.02, random_state=random_state)
+            model.fit(baseline)
+        self.model = model
+        # Bounded ring buffer; the anomalies table is the durable record
+        self._alerts = deque(maxlen=MAX_ALERTS)
+
+    def score_batch(self, data):
+        """Return (scores, mask): higher score => more anomalous, mask marks outliers."""
+        X = np.asarray(data, dtype=float)
+        scores = -self.model.score_samples(X)
+        # same decision as model.predict(X) == -1, without scoring every tree twice
+        mask = -scores - self.model.offset_ < 0
+        return scores, mask
+
+    def remember(self, mask: np.ndarray, scores: np.ndarray, timestamps: np.ndarray) -> List[dict]:
+        """Record the rows selected by mask in the recent-alerts buffer and return them."""
+        idx = np.flatnonzero(mask)
+        scores, timestamps = scores[idx], timestamps[idx]
+        alerts = [
+            {"timestamp": t, "index": i, "score": sc, "explanation": MODEL_EXPLANATION}
+            for t, i, sc in zip(timestamps.tolist(), idx.tolist(), scores.tolist())
+        ]
+        self._alerts.extend(alerts)
+        return alerts
+
+    def diagnose(self, data: List[List[float]], timestamps: Optional[np.ndarray] = None):
+        scores, mask = self.score_batch(data)
+        # stamp outliers with their reading's time when known
+        ts = np.full(mask.shape[0], time.time()) if timestamps is None else np.asarray(timestamps, dtype=float)
+        anomalies = self.remember(mask, scores, ts)
         return {
             "detected": len(anomalies),
             "anomalies": anomalies,
@@ -45,18 +65,17 @@ class AnomalyDetector:
 
     def fit_with_user_data(self, rows: List[List[float]]):
         X = np.array(rows, dtype=float)
-        # Retrain (IsolationForest lacks partial_fit)
-        self.model.fit(X)
+        # Retrain (IsolationForest lacks partial_fit) on a fresh estimator so a
+        # model shared with other detectors is never mutated in place
+        from sklearn.base import clone
+        self.model = clone(self.model).fit(X)
         return True
 
     def get_recent_alerts(self, limit: int = 10):
-        return self._alerts[-limit:]
+        return list(self._alerts)[-limit:]
 
 def get_sensor_data(n: int = 128, features: int = 3):
-    # Placeholder for real IoT integration; generate synthetic series with occasional spikes
-    rng = np.random.default_rng()
-    base = rng.normal(loc=100.0, scale=10.0, size=(n, features))
-    # inject a random spike
-    idx = rng.integers(0, n)
-    base[idx, :] *= 1.8
-    return base.tolist()
+    # Placeholder for real IoT integration; synthetic series with one random spike
+    from generators import generate
+    _, X, _ = generate(n, 'baseline', anomalies=1, seed=None)
+    return X[:, :features].tolist()
@@ -0,0 +1,235 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+from sqlalchemy import delete, select, update
+from background import log_failure
+from db import get_session, write_session, IngestOutbox, Sensor
+from events import notifier
+from ingest import STAMP_STEP, SensorBatch
+
+# Asynchronous ingest: requests append the raw batch here and return 202; the
+# worker drains many batches at once, so detection, rollups and the anomaly
+# insert are paid once per micro-batch instead of once per request.
+OUTBOX_BATCH_ROWS = int(os.environ.get("OUTBOX_BATCH_ROWS", 200_000))  # rows claimed per drain
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", 60))  # seconds before a crashed worker's claim expires
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5))  # failed batches then stay for inspection
+OUTBOX_RETRY_DELAY = float(os.environ.get("OUTBOX_RETRY_DELAY", 30))  # seconds before a failed batch is claimed again
+ROW_DTYPE = np.dtype('<f8')
+ROW_COLUMNS = 5  # timestamp, v1, v2, v3, stamped
+
+log = logging.getLogger(__name__)
+
+
+def enqueue(s, user_id: int, sensor_id: int, X: np.ndarray, ts: np.ndarray, stamped: np.ndarray) -> int:
+    """Append a parsed batch in the caller's write transaction; returns its outbox id."""
+    rows = np.column_stack([ts, X, stamped]).astype(ROW_DTYPE)
+    item = IngestOutbox(user_id=user_id, sensor_id=sensor_id, n=int(ts.shape[0]), rows=rows.tobytes())
+    s.add(item)
+    s.flush()
+    return item.id
+
+
+def _rows(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=ROW_DTYPE).reshape(-1, ROW_COLUMNS)
+
+
+def claim(max_rows: int = OUTBOX_BATCH_ROWS, lease: float = OUTBOX_LEASE) -> List[Tuple[int, int, int, bytes]]:
+    """Lease the oldest pending batches, up to `max_rows` readings (at least one batch).
+
+    Returns (id, user_id, sensor_id, rows). A lease that is not released or
+    deleted expires after `lease` seconds and the batches are claimed again.
+    """
+    now = time.time()
+    with write_session() as s:
+        pending = s.execute(
+            select(IngestOutbox.id, IngestOutbox.n)
+            .where(IngestOutbox.claimed_until < now, IngestOutbox.attempts < OUTBOX_MAX_ATTEMPTS)
+            .order_by(IngestOutbox.id)
+            .limit(max(1, max_rows))
+        ).all()
+        ids, total = [], 0
+        for id_, n in pending:
+            if ids and total + n > max_rows:
+                break
+            ids.append(id_)
+            total += n
+        if not ids:
+            return []
+        s.execute(update(IngestOutbox).where(IngestOutbox.id.in_(ids)).values(claimed_until=now + lease))
+        return [tuple(r) for r in s.execute(
+            select(IngestOutbox.id, IngestOutbox.user_id, IngestOutbox.sensor_id, IngestOutbox.rows)
+            .where(IngestOutbox.id.in_(ids)).order_by(IngestOutbox.id)
+        ).all()]
+
+
+def _merge(parts: List[np.ndarray]) -> np.ndarray:
+    """Concatenate one sensor's batches in arrival order. Server-stamped rows of a
+    later batch are moved past the earlier ones so no two batches share an instant."""
+    out = [parts[0]]
+    last = parts[0][:, 0].max()
+    for A in parts[1:]:
+        stamped = A[:, 4] > 0
+        if stamped.any() and A[stamped, 0].min() <= last:
+            A = A.copy()
+            A[stamped, 0] += last + STAMP_STEP - A[stamped, 0].min()
+        out.append(A)
+        last = max(last, A[:, 0].max())
+    return np.concatenate(out)
+
+
+def _batches(registry, groups: Dict[Tuple[int, int], List[bytes]]) -> Dict[Tuple[int, int], SensorBatch]:
+    """A scored SensorBatch per (user, sensor); sensors deleted since the batch was queued are left out."""
+    batches = {}
+    with get_session() as s:
+        types = dict(s.execute(select(Sensor.id, Sensor.type).where(Sensor.id.in_({k[1] for k in groups}))).all())
+        owners = dict(s.execute(select(Sensor.id, Sensor.user_id).where(Sensor.id.in_(types))).all())
+        for (user_id, sensor_id), parts in groups.items():
+            if owners.get(sensor_id) != user_id:
+                continue
+            A = _merge([_rows(blob) for blob in parts])
+            batch = SensorBatch(user_id, sensor_id, types[sensor_id], A[:, 1:4], A[:, 0], A[:, 4] > 0)
+            batch.drop_stored(s)
+            batches[(user_id, sensor_id)] = batch
+    for batch in batches.values():
+        batch.score(registry)
+    return batches
+
+
+def _write(batches: List[SensorBatch], ids: List[int]) -> int:
+    """Store the batches and delete their outbox rows in one transaction; returns rows inserted."""
+    with write_session() as s:
+        inserted = sum(batch.write(s) for batch in batches)
+        s.execute(delete(IngestOutbox).where(IngestOutbox.id.in_(ids)))
+    return inserted
+
+
+def drain(registry, retrainer=None, max_rows: int = OUTBOX_BATCH_ROWS) -> dict:
+    """Process one micro-batch from the outbox; returns counts (all zero when it was empty).
+
+    Scoring runs outside the write lock. Readings, rollups, anomalies, detector
+    state and the removal of the claimed batches then commit in one transaction.
+    If that fails, each sensor is retried in a transaction of its own, and only
+    the batches of sensors that fail again are released with an attempt counted.
+    """
+    t0 = time.perf_counter()
+    claimed = claim(max_rows)
+    result = {"batches": len(claimed), "readings": 0, "inserted": 0, "anomalies": 0, "failed": 0}
+    if not claimed:
+        return result
+    groups: Dict[Tuple[int, int], List[bytes]] = {}
+    group_ids: Dict[Tuple[int, int], List[int]] = {}
+    for id_, user_id, sensor_id, blob in claimed:
+        groups.setdefault((user_id, sensor_id), []).append(blob)
+        group_ids.setdefault((user_id, sensor_id), []).append(id_)
+        result["readings"] += len(blob) // (ROW_DTYPE.itemsize * ROW_COLUMNS)
+    done = []
+    try:
+        batches = _batches(registry, groups)
+        result["inserted"] = _write(list(batches.values()), [c[0] for c in claimed])
+        done = list(batches.values())
+    except Exception:
+        log.exception("outbox drain of %d batches failed; retrying per sensor", len(claimed))
+        # batches were mutated by the rolled-back write: rebuild each from its rows
+        for key, parts in groups.items():
+            try:
+                batch = _batches(registry, {key: parts}).get(key)
+                result["inserted"] += _write([batch] if batch else [], group_ids[key])
+                if batch:
+                    done.append(batch)
+            except Exception as e:
+                log.exception("outbox batches %s for sensor %s failed", group_ids[key], key[1])
+                release(group_ids[key], f"{type(e).__name__}: {e}")
+                result["failed"] += len(group_ids[key])
+    users = set()
+    for batch in done:
+        batch.remember()
+        result["anomalies"] += len(batch.records)
+        if batch.records:
+            users.add(batch.user_id)
+        if retrainer is not None:
+            retrainer.note_ingest(batch.user_id, int(batch.ts.shape[0]), batch.sensor_type)
+    for uid in users:
+        notifier.notify(uid)
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+
+def release(ids: List[int], error: str) -> None:
+    """Give claimed batches back after a failed drain, counting the attempt."""
+    with write_session() as s:
+        s.execute(update(IngestOutbox).where(IngestOutbox.id.in_(ids)).values(
+            claimed_until=time.time() + OUTBOX_RETRY_DELAY, attempts=IngestOutbox.attempts + 1, error=error[:1000]))
+
+
+def requeue() -> int:
+    """Make batches that used up their attempts claimable again; returns how many."""
+    with write_session() as s:
+        return s.execute(update(IngestOutbox).where(IngestOutbox.attempts >= OUTBOX_MAX_ATTEMPTS).values(
+            claimed_until=0.0, attempts=0)).rowcount
+
+
+def pending() -> dict:
+    with get_session() as s:
+        rows = s.execute(select(IngestOutbox.n, IngestOutbox.attempts)).all()
+    live = [n for n, attempts in rows if attempts < OUTBOX_MAX_ATTEMPTS]
+    return {"batches": len(live), "readings": int(sum(live)), "failed": len(rows) - len(live)}
+
+
+class OutboxWorker:
+    """Drains the outbox on one background thread. `kick()` after an enqueue;
+    kicks that arrive while a drain is queued coalesce into it."""
+
+    def __init__(self, registry, retrainer=None, max_rows: int = OUTBOX_BATCH_ROWS):
+        self.registry = registry
+        self.retrainer = retrainer
+        self.max_rows = max_rows
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self._lock = threading.Lock()
+        self._queued = False
+
+    def kick(self) -> bool:
+        with self._lock:
+            if self._queued:
+                return False
+            self._queued = True
+        self._pool.submit(self._run).add_done_callback(log_failure(log, "outbox drain"))
+        return True
+
+    def _run(self):
+        with self._lock:
+            self._queued = False
+        # keep going while batches come back; released failures wait for the next kick
+        while True:
+            r = drain(self.registry, self.retrainer, self.max_rows)
+            if not r["batches"] or r["failed"]:
+                break
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import ensure_schema
+    from registry import ModelRegistry
+    ap = argparse.ArgumentParser(description="Drain the asynchronous ingest outbox.")
+    ap.add_argument("--loop", action="store_true", help="keep polling instead of exiting once the outbox is empty")
+    ap.add_argument("--interval", type=float, default=1.0, help="seconds between polls with --loop")
+    ap.add_argument("--max-rows", type=int, default=OUTBOX_BATCH_ROWS)
+    ap.add_argument("--requeue", action="store_true", help=f"retry batches that failed {OUTBOX_MAX_ATTEMPTS} times, then drain")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ensure_schema()
+    if args.requeue:
+        print(f"requeued {requeue()} batches")
+    registry = ModelRegistry()
+    while True:
+        r = drain(registry, max_rows=args.max_rows)
+        if r["batches"]:
+            print(r)
+        elif not args.loop:
+            break
+        else:
+            time.sleep(args.interval)
+    print(pending())
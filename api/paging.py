@@ -0,0 +1,47 @@
+from typing import Optional, Tuple
+from sqlalchemy import and_, or_
+
+MAX_PAGE = 10000
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(ts: float, row_id: int) -> str:
+    return f"{ts!r}:{row_id}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if not cursor:
+        return None
+    try:
+        ts, row_id = cursor.split(":", 1)
+        return float(ts), int(row_id)
+    except ValueError:
+        raise CursorError("invalid_cursor")
+
+
+def time_filter(q, ts_col, since: Optional[float] = None, until: Optional[float] = None):
+    if since is not None:
+        q = q.filter(ts_col >= since)
+    if until is not None:
+        q = q.filter(ts_col < until)
+    return q
+
+
+def keyset_page(q, ts_col, id_col, cursor: Optional[str], limit: int):
+    """Newest-first page of `q` strictly older than `cursor` on (timestamp, id).
+
+    Returns (rows, next_cursor); rows keep the query's column order and must
+    start with (id, timestamp). next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, MAX_PAGE))
+    after = decode_cursor(cursor)
+    if after:
+        ts, row_id = after
+        q = q.filter(or_(ts_col < ts, and_(ts_col == ts, id_col < row_id)))
+    rows = q.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (encode_cursor(rows[-1][1], rows[-1][0]) if more else None)
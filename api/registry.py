@@ -0,0 +1,167 @@
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from model import AnomalyDetector
+from db import get_session, write_session, ModelArtifact
+
+BASELINE_PATH = os.environ.get("BASELINE_MODEL_PATH", os.path.join(os.path.dirname(__file__), "baseline_model.pkl.z"))
+MODEL_CACHE_BYTES = int(os.environ.get("MODEL_CACHE_BYTES", 64 * 1024 * 1024))
+# Cached models are re-checked against the `models` table this often, so a model
+# trained on another instance is picked up within this many seconds
+MODEL_CACHE_TTL = float(os.environ.get("MODEL_CACHE_TTL", 30))
+# Nominal charge for entries sharing the baseline model (alert list only)
+SHARED_ENTRY_BYTES = 1024
+
+
+def pack_model(model) -> Tuple[bytes, int]:
+    """(compressed blob, pickled size); the pickled size tracks the fitted trees'
+    arrays, so it stands in for the loaded model's memory."""
+    raw = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    return zlib.compress(raw, 6), len(raw)
+
+
+def unpack_model(blob: bytes):
+    """(model, pickled size) from a blob written by pack_model."""
+    raw = zlib.decompress(blob)
+    return pickle.loads(raw), len(raw)
+
+
+def build_baseline(path: str = BASELINE_PATH) -> int:
+    # Regenerate the shipped artifact: `python api/registry.py`
+    blob = pack_model(AnomalyDetector().model)[0]
+    with open(path, "wb") as f:
+        f.write(blob)
+    return len(blob)
+
+
+class ModelRegistry:
+    """Per-user (and optionally per sensor type) IsolationForest models.
+
+    Fitted models are stored in the `models` table and lazily loaded into an
+    LRU cache bounded by the uncompressed size of its entries. Users without a
+    trained model share the prebuilt baseline, each with its own alert list.
+    A user's entries are dropped when their row count or newest `updated_at` in
+    `models` has changed, checked at most every `ttl` seconds.
+    """
+
+    def __init__(self, max_bytes: int = MODEL_CACHE_BYTES, baseline_path: str = BASELINE_PATH,
+                 ttl: float = MODEL_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.baseline_path = baseline_path
+        self.ttl = ttl
+        self._baseline = None
+        self._cache: "OrderedDict[Tuple[int, str], Tuple[AnomalyDetector, int]]" = OrderedDict()
+        self._bytes = 0
+        self._checked: Dict[int, Tuple[tuple, float]] = {}  # user_id -> (models version, checked at)
+        self._lock = threading.RLock()
+
+    @property
+    def baseline(self):
+        if self._baseline is None:
+            with self._lock:
+                if self._baseline is None:
+                    try:
+                        with open(self.baseline_path, "rb") as f:
+                            self._baseline = unpack_model(f.read())[0]
+                    except Exception:
+                        # Missing or incompatible artifact: fall back to training
+                        self._baseline = AnomalyDetector().model
+        return self._baseline
+
+    def _put(self, key: Tuple[int, str], det: AnomalyDetector, size: int) -> None:
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._cache[key] = (det, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._cache) > 1:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._bytes -= evicted
+
+    def _lookup(self, key: Tuple[int, str]) -> Optional[AnomalyDetector]:
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit:
+                self._cache.move_to_end(key)
+                return hit[0]
+        return None
+
+    def _drop_user(self, user_id: int) -> None:
+        with self._lock:
+            for k in [k for k in self._cache if k[0] == user_id]:
+                self._bytes -= self._cache.pop(k)[1]
+
+    @staticmethod
+    def _version(s, user_id: int) -> tuple:
+        return tuple(s.query(func.count(ModelArtifact.id), func.max(ModelArtifact.updated_at)).filter_by(user_id=user_id).one())
+
+    def _revalidate(self, user_id: int) -> None:
+        """Drop the user's cached models if another instance has trained since they were loaded."""
+        with self._lock:
+            checked = self._checked.get(user_id)
+        now = time.monotonic()
+        if checked and now - checked[1] < self.ttl:
+            return
+        with get_session() as s:
+            version = self._version(s, user_id)
+        with self._lock:
+            if checked and checked[0] != version:
+                self._drop_user(user_id)
+            self._checked[user_id] = (version, now)
+
+    def get(self, user_id: int, sensor_type: Optional[str] = None) -> AnomalyDetector:
+        """Return the most specific model for the user: per type, per user, then baseline."""
+        keys = [(user_id, (sensor_type or "").lower()), (user_id, "")]
+        keys = list(OrderedDict.fromkeys(keys))
+        self._revalidate(user_id)
+        for key in keys:
+            det = self._lookup(key)
+            if det is not None:
+                return det
+        with get_session() as s:
+            for key in keys:
+                art = s.query(ModelArtifact).filter_by(user_id=key[0], sensor_type=key[1]).first()
+                if art:
+                    # charge the uncompressed size: the blob is about a quarter of the loaded model
+                    model, size = unpack_model(art.blob)
+                    det = AnomalyDetector(model=model)
+                    self._put(key, det, size)
+                    # later lookups for the more specific key resolve to the same model;
+                    # charging the alias the full size keeps the bound conservative
+                    if key != keys[0]:
+                        self._put(keys[0], det, size)
+                    return det
+        det = AnomalyDetector(model=self.baseline)
+        for key in keys:
+            self._put(key, det, SHARED_ENTRY_BYTES)
+        return det
+
+    def train(self, user_id: int, rows: List[List[float]], sensor_type: Optional[str] = None) -> AnomalyDetector:
+        key = (user_id, (sensor_type or "").lower())
+        det = AnomalyDetector(model=self.baseline)
+        det.fit_with_user_data(rows)
+        blob, size = pack_model(det.model)
+        with write_session() as s:
+            art = s.query(ModelArtifact).filter_by(user_id=key[0], sensor_type=key[1]).first()
+            if not art:
+                art = ModelArtifact(user_id=key[0], sensor_type=key[1])
+                s.add(art)
+            art.blob = blob
+            art.trained_on = len(rows)
+            art.updated_at = time.time()
+        with self._lock:
+            # drop every cached resolution for this user so type-specific keys re-resolve
+            self._drop_user(user_id)
+            self._checked.pop(user_id, None)
+        self._put(key, det, size)
+        return det
+
+
+if __name__ == "__main__":
+    print(f"wrote {build_baseline()} bytes to {BASELINE_PATH}")
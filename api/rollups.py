@@ -0,0 +1,165 @@
+import time
+from typing import Optional
+import numpy as np
+from sqlalchemy import case, select
+from sqlalchemy.dialects import postgresql, sqlite
+from db import bulk_insert, write_session, Rollup, Sensor, Reading
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+
+def pick_resolution(window: float) -> int:
+    # Coarsest resolution that still gives a useful number of buckets
+    if window <= 2 * HOUR:
+        return MINUTE
+    if window <= 7 * DAY:
+        return HOUR
+    return DAY
+
+
+def _upsert(s):
+    return (postgresql.insert if s.bind.dialect.name == "postgresql" else sqlite.insert)(Rollup)
+
+
+def _bucket_arrays(X: np.ndarray, ts: np.ndarray, resolution: int) -> dict:
+    """Rollup columns for one sensor's batch: count/sum/min/max and the latest vector per bucket."""
+    buckets = np.floor(ts / resolution) * resolution
+    # sort by (bucket, ts) so each group is contiguous and its last row is the newest
+    order = np.lexsort((ts, buckets))
+    b, t, V = buckets[order], ts[order], X[order]
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    ends = np.r_[starts[1:], b.shape[0]] - 1
+    return {
+        "resolution": np.full(starts.shape[0], resolution),
+        "bucket": b[starts],
+        "count": np.diff(np.r_[starts, b.shape[0]]),
+        "sum": np.add.reduceat(V.sum(axis=1), starts),
+        "min": np.minimum.reduceat(V.min(axis=1), starts),
+        "max": np.maximum.reduceat(V.max(axis=1), starts),
+        "last_ts": t[ends],
+        "last_v1": V[ends, 0], "last_v2": V[ends, 1], "last_v3": V[ends, 2],
+    }
+
+
+def bucket_stats(X: np.ndarray, ts: np.ndarray, resolution: int) -> list:
+    """Group one sensor's batch into buckets: count/sum/min/max and the latest vector."""
+    cols = {k: v.tolist() for k, v in _bucket_arrays(X, ts, resolution).items()}
+    return [dict(zip(cols, r)) for r in zip(*cols.values())]
+
+
+def update_rollups(s, user_id: int, sensor_id: int, X: np.ndarray, ts: np.ndarray) -> None:
+    """Merge a batch of one sensor's readings into its minute/hour/day rollups (caller commits)."""
+    if not X.shape[0]:
+        return
+    rows = []
+    for res in RESOLUTIONS:
+        for r in bucket_stats(X, ts, res):
+            r.update(user_id=user_id, sensor_id=sensor_id)
+            rows.append(r)
+    s.execute(_merge(s), rows)
+
+
+def _merge(s):
+    """Upsert that adds a batch's bucket stats into existing buckets."""
+    stmt = _upsert(s)
+    ex = stmt.excluded
+    newer = ex["last_ts"] >= Rollup.last_ts
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Rollup.sensor_id, Rollup.resolution, Rollup.bucket],
+        set_={
+            "count": Rollup.count + ex["count"],
+            "sum": Rollup.sum + ex["sum"],
+            "min": case((ex["min"] < Rollup.min, ex["min"]), else_=Rollup.min),
+            "max": case((ex["max"] > Rollup.max, ex["max"]), else_=Rollup.max),
+            "last_ts": case((newer, ex["last_ts"]), else_=Rollup.last_ts),
+            "last_v1": case((newer, ex["last_v1"]), else_=Rollup.last_v1),
+            "last_v2": case((newer, ex["last_v2"]), else_=Rollup.last_v2),
+            "last_v3": case((newer, ex["last_v3"]), else_=Rollup.last_v3),
+        },
+    )
+    return stmt
+
+
+def append_rollups(s, user_id: int, sensor_id: int, X: np.ndarray, ts: np.ndarray) -> None:
+    """update_rollups for rows newer than every stored reading of the sensor (seeding).
+
+    Only the first bucket of each resolution can exist already, so it alone is merged
+    and the rest go in with one plain insert per resolution.
+    """
+    if not X.shape[0]:
+        return
+    for res in RESOLUTIONS:
+        cols = {k: v.tolist() for k, v in _bucket_arrays(X, ts, res).items()}
+        n = len(cols["bucket"])
+        cols.update(user_id=[user_id] * n, sensor_id=[sensor_id] * n)
+        s.execute(_merge(s), [{k: v[0] for k, v in cols.items()}])
+        bulk_insert(s, Rollup.__table__, {k: v[1:] for k, v in cols.items()})
+
+
+def rebuild_rollups(user_id: Optional[int] = None, chunk_rows: int = 50000) -> int:
+    """Recompute rollups from stored readings (backfill for data ingested before rollups existed)."""
+    with write_session() as s:
+        q = s.query(Rollup)
+        if user_id is not None:
+            q = q.filter(Rollup.user_id == user_id)
+        q.delete(synchronize_session=False)
+        q = select(Reading.user_id, Reading.sensor_id, Reading.timestamp, Reading.v1, Reading.v2, Reading.v3)
+        if user_id is not None:
+            q = q.where(Reading.user_id == user_id)
+        n = 0
+        for part in s.execute(q.execution_options(yield_per=chunk_rows)).partitions():
+            A = np.asarray(part, dtype=float)
+            for sid in np.unique(A[:, 1]):
+                sel = A[A[:, 1] == sid]
+                update_rollups(s, int(sel[0, 0]), int(sid), sel[:, 3:6], sel[:, 2])
+            n += A.shape[0]
+    return n
+
+
+def rollup_rows(s, user_id: int, window: float, sensor_id: Optional[int] = None):
+    res = pick_resolution(window)
+    since = float(np.floor((time.time() - window) / res) * res)
+    q = (
+        s.query(Sensor.room, Rollup.sensor_id, Rollup.count, Rollup.sum, Rollup.min, Rollup.max,
+                Rollup.last_ts, Rollup.last_v1, Rollup.last_v2, Rollup.last_v3)
+        .join(Sensor, Rollup.sensor_id == Sensor.id)
+        .filter(Rollup.user_id == user_id, Rollup.resolution == res, Rollup.bucket >= since)
+    )
+    if sensor_id:
+        q = q.filter(Rollup.sensor_id == sensor_id)
+    return res, q.all()
+
+
+def rooms_from_rollups(s, user_id: int, window: float) -> dict:
+    """room -> {reading_count, total, last, last_ts} over the trailing window."""
+    rooms = {}
+    for room, _sid, n, sm, _mn, _mx, lt, a, b, c in rollup_rows(s, user_id, window)[1]:
+        entry = rooms.setdefault(room, {"reading_count": 0, "total": 0.0, "last": [0.0, 0.0, 0.0], "last_ts": 0})
+        entry["reading_count"] += n
+        entry["total"] += sm
+        if lt > entry["last_ts"]:
+            entry["last_ts"] = lt
+            entry["last"] = [a, b, c]
+    return rooms
+
+
+def report_from_rollups(s, user_id: int, window: float, sensor_id: Optional[int] = None) -> dict:
+    """Same shape as AnomalyDetector.generate_report, computed over stored data."""
+    res, rows = rollup_rows(s, user_id, window, sensor_id)
+    samples = sum(r[2] for r in rows)
+    total = sum(r[3] for r in rows)
+    return {
+        "consumption_kwh": float(total),
+        "peak_value": float(max((r[5] for r in rows), default=0.0)),
+        "avg_value": float(total / (samples * 3)) if samples else 0.0,
+        "samples": int(samples),
+        "window": window,
+        "resolution": res,
+    }
+
+
+if __name__ == "__main__":
+    from db import ensure_schema
+    ensure_schema()
+    print(f"rebuilt rollups from {rebuild_rollups()} readings")
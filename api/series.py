@@ -0,0 +1,95 @@
+from typing import Optional
+import numpy as np
+from sqlalchemy import Integer, cast, func, select
+from db import Reading
+
+MAX_POINTS = 5000
+# Binary alternative to JSON for chart payloads, chosen via Accept: little-endian
+# float32 rows; the first column is seconds after the X-Series-T0 header when present
+SERIES_MIMETYPE = "application/vnd.voltguard.series+f32"
+BUCKET_COLUMNS = ["t", "n", "v1_min", "v1_max", "v1_avg", "v2_min", "v2_max", "v2_avg", "v3_min", "v3_max", "v3_avg"]
+# LTTB runs on at most the lowest and highest reading of LTTB_OVERSAMPLE * points
+# fine buckets, picked in SQL, so its cost follows the chart width rather than the range
+LTTB_OVERSAMPLE = 4
+
+
+def _reading_filter(q, user_id: int, sensor_id: Optional[int], since: float, until: float):
+    q = q.where(Reading.user_id == user_id, Reading.timestamp >= since, Reading.timestamp < until)
+    if sensor_id:
+        q = q.where(Reading.sensor_id == sensor_id)
+    return q
+
+
+def _bucket_index(s, since: float, width: float):
+    offset = (Reading.timestamp - since) / width
+    # timestamps are >= since, so truncation is floor; Postgres' integer cast rounds instead
+    return func.floor(offset) if s.bind.dialect.name == "postgresql" else cast(offset, Integer)
+
+
+def bucket_series(s, user_id: int, sensor_id: Optional[int], since: float, until: float, points: int):
+    """Per-phase min/max/avg over `points` equal-width time buckets, aggregated in SQL.
+
+    Empty buckets are omitted; `t` is the bucket start.
+    """
+    width = max((until - since) / points, 1e-9)
+    idx = _bucket_index(s, since, width).label("b")
+    aggs = []
+    for col in (Reading.v1, Reading.v2, Reading.v3):
+        aggs += [func.min(col), func.max(col), func.avg(col)]
+    q = _reading_filter(select(idx, func.count(), *aggs), user_id, sensor_id, since, until).group_by(idx).order_by(idx)
+    rows = s.execute(q).all()
+    return width, [[since + int(b) * width, n, *vals] for b, n, *vals in rows]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points that preserve the shape of y(x)."""
+    n = x.shape[0]
+    if threshold >= n:
+        return np.arange(n)
+    threshold = max(threshold, 3)
+    every = (n - 2) / (threshold - 2)
+    # bucket i spans [edges[i], edges[i + 1]); first and last points are always kept
+    edges = np.minimum((np.arange(threshold) * every).astype(int) + 1, n)
+    out = np.empty(threshold, dtype=int)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # the next bucket's centroid is the third triangle vertex
+        cx, cy = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def lttb_series(s, user_id: int, sensor_id: Optional[int], since: float, until: float, points: int, phase: str = "total"):
+    """Raw [ts, v1, v2, v3] rows picked by LTTB on one phase (or the v1+v2+v3 total)."""
+    cols = (Reading.timestamp, Reading.v1, Reading.v2, Reading.v3)
+    fine = LTTB_OVERSAMPLE * points
+    n, t_min, t_max = s.execute(_reading_filter(select(func.count(), func.min(Reading.timestamp), func.max(Reading.timestamp)),
+                                                user_id, sensor_id, since, until)).one()
+    if n <= 2 * fine:
+        q = _reading_filter(select(*cols), user_id, sensor_id, since, until).order_by(Reading.timestamp)
+    else:
+        y = Reading.v1 + Reading.v2 + Reading.v3 if phase == "total" else getattr(Reading, phase)
+        # buckets span the stored readings, not the requested range, which may be mostly empty
+        b = _bucket_index(s, t_min, max((t_max - t_min) * (1 + 1e-9) / fine, 1e-9))
+        lo = func.row_number().over(partition_by=b, order_by=(y, Reading.timestamp)).label("lo")
+        hi = func.row_number().over(partition_by=b, order_by=(y.desc(), Reading.timestamp)).label("hi")
+        sub = _reading_filter(select(*cols, lo, hi), user_id, sensor_id, since, until).subquery()
+        q = (select(sub.c.timestamp, sub.c.v1, sub.c.v2, sub.c.v3)
+             .where((sub.c.lo == 1) | (sub.c.hi == 1)).order_by(sub.c.timestamp))
+    A = np.asarray(s.execute(q).all(), dtype=float).reshape(-1, 4)
+    if not A.shape[0]:
+        return []
+    y = A[:, 1:].sum(axis=1) if phase == "total" else A[:, {"v1": 1, "v2": 2, "v3": 3}[phase]]
+    return A[lttb(A[:, 0], y, points)].tolist()
+
+
+def pack_series(data, ncols: int, t0: Optional[float] = None) -> bytes:
+    A = np.asarray(data, dtype=float).reshape(-1, ncols)
+    if t0 is not None:
+        # float32 cannot hold epoch seconds precisely; offsets within a window can
+        A[:, 0] -= t0
+    return A.astype("<f4").tobytes()
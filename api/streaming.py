@@ -0,0 +1,213 @@
+import os
+import time
+from typing import Optional, Tuple
+import numpy as np
+from db import SensorState
+
+# Per sensor type prior: (mu, sigma, z-threshold). Seeds a new sensor's state so
+# scoring works from its first reading and adapts to the device from there.
+TYPE_RULES = {
+    'meter': (120.0, 15.0, 3.0),
+    'phase': (100.0, 10.0, 2.5),
+    'plug':  (20.0,  8.0, 2.0),
+}
+DEFAULT_RULE = (100.0, 10.0, 3.0)
+
+STREAM_ALPHA = float(os.environ.get("STREAM_ALPHA", 0.01))  # EWMA weight per reading
+if not 0.0 < STREAM_ALPHA < 1.0:
+    raise ValueError(f"STREAM_ALPHA must be in (0, 1), got {STREAM_ALPHA}")
+MEDIAN_WINDOW = 500  # readings; sets how fast median/MAD follow the sensor
+CUSUM_K = 0.5  # slack, in sigmas
+CUSUM_H = 8.0  # drift alarm threshold, in sigmas
+CLIP_SIGMAS = 4.0  # outliers are winsorized before they update the state
+# Clip bounds, median/MAD and the spike/dip references are held for a block of
+# REF_BLOCK readings, counted over the sensor's lifetime, so scores do not depend
+# on how the readings were split into uploads
+REF_BLOCK = 32
+_BLOCK = 256
+_MIN_LOG10_POWER = -100.0  # smallest r^k used by _ema, as a power of ten
+
+# state rows, one column per phase; LO/HI are the clip bounds of the current block,
+# followed by its winsorized readings so far (n % REF_BLOCK of them)
+MEAN, VAR, MEDIAN, MAD, CUSUM_POS, CUSUM_NEG, LO, HI, PENDING = range(9)
+STATE_ROWS = PENDING + REF_BLOCK - 1
+
+
+def _ema(u: np.ndarray, s0: np.ndarray, a: float) -> np.ndarray:
+    """s_t = (1 - a) s_{t-1} + a u_t for every row, vectorized in blocks.
+
+    Within a block s_t = r^t (s0 + a * sum_k r^-k u_k); blocks keep r^-k finite,
+    shrinking for large `a` so that r^block stays far from underflow.
+    """
+    r = 1.0 - a
+    block = min(_BLOCK, max(1, int(_MIN_LOG10_POWER / np.log10(r))))
+    out = np.empty_like(u)
+    pw = r ** np.arange(1, block + 1, dtype=float)[:, None]
+    s = s0
+    for i in range(0, u.shape[0], block):
+        ub = u[i:i + block]
+        p = pw[:ub.shape[0]]
+        out[i:i + ub.shape[0]] = p * (s + a * np.cumsum(ub / p, axis=0))
+        s = out[i + ub.shape[0] - 1]
+    return out
+
+
+def _cusum(y: np.ndarray, s0) -> np.ndarray:
+    """Lindley recursion S_t = max(0, S_{t-1} + y_t) in closed form."""
+    c = np.cumsum(y, axis=0)
+    return c - np.minimum(-s0, np.minimum.accumulate(c, axis=0))
+
+
+def _median(block: np.ndarray) -> np.ndarray:
+    """Column medians of a full block (cheaper than np.median at this size)."""
+    s = np.sort(block, axis=0)
+    m = REF_BLOCK // 2
+    return s[m] if REF_BLOCK % 2 else 0.5 * (s[m - 1] + s[m])
+
+
+def _cusum_alarms(y: np.ndarray, s0: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """CUSUM per column that resets to 0 on the row where it crosses CUSUM_H.
+
+    Returns (alarm, end state); restarts once per alarm, which are rare.
+    """
+    c = _cusum(y, s0)
+    alarm = c > CUSUM_H
+    if not alarm.any():
+        return alarm, c[-1]
+    alarm[:] = False
+    end = np.empty(y.shape[1])
+    for j in range(y.shape[1]):
+        i, s = 0, s0[j]
+        while True:
+            c = _cusum(y[i:, j], s)
+            hit = np.flatnonzero(c > CUSUM_H)
+            if not hit.size:
+                end[j] = c[-1] if c.shape[0] else s
+                break
+            i += int(hit[0])
+            alarm[i, j] = True
+            i, s = i + 1, 0.0
+    return alarm, end
+
+
+class SensorDetector:
+    """O(1)-memory online baseline for one sensor: EWMA mean/variance, a rolling
+    median/MAD and two-sided CUSUM drift detection, per phase."""
+
+    def __init__(self, state: np.ndarray, n: int = 0, zthr: float = 3.0):
+        self.state = state
+        self.n = n
+        self.zthr = zthr
+
+    @classmethod
+    def prior(cls, sensor_type: Optional[str]) -> "SensorDetector":
+        mu, sigma, zthr = TYPE_RULES.get((sensor_type or 'meter').lower(), DEFAULT_RULE)
+        state = np.zeros((STATE_ROWS, 3))
+        state[MEAN], state[VAR] = mu, sigma ** 2
+        state[MEDIAN], state[MAD] = mu, sigma / 1.4826
+        state[LO], state[HI] = mu - CLIP_SIGMAS * sigma, mu + CLIP_SIGMAS * sigma
+        return cls(state, 0, zthr)
+
+    @classmethod
+    def load(cls, row: Optional[SensorState], sensor_type: Optional[str]) -> "SensorDetector":
+        det = cls.prior(sensor_type)
+        if row is not None:
+            saved = np.frombuffer(row.state, dtype='<f8').reshape(-1, 3)
+            det.state[:saved.shape[0]] = saved
+            det.n = row.n
+            if saved.shape[0] < STATE_ROWS:  # saved before blocks: the open block starts at the baseline
+                det.state[PENDING:] = det.state[MEDIAN]
+                det._set_bounds()
+        return det
+
+    def dump(self) -> bytes:
+        return self.state.astype('<f8').tobytes()
+
+    def score(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Score rows against the state before each of them, then advance the state.
+
+        Returns (mask, score, kind) with kind in {"z", "spike", "dip", "drift"}.
+        """
+        n = X.shape[0]
+        mean_prev, sd_prev, median, mad = (np.empty_like(X) for _ in range(4))
+        drift = np.zeros(n, dtype=bool)
+        i = 0
+        while i < n:
+            # blocks follow the lifetime count, so a batch may start or end mid-block
+            j = min(n, i + REF_BLOCK - self.n % REF_BLOCK)
+            median[i:j], mad[i:j] = self.state[MEDIAN], self.state[MAD]
+            mean_prev[i:j], sd_prev[i:j], drift[i:j] = self._advance(X[i:j])
+            i = j
+
+        z = np.abs(X - mean_prev) / sd_prev
+        rz = np.abs(X - median) / np.maximum(1.4826 * mad, 1e-6)
+        zmax, rzmax = z.max(axis=1), rz.max(axis=1)
+        spike = X.max(axis=1) > median.max(axis=1) * 1.6
+        dip = X.min(axis=1) < median.min(axis=1) * 0.6
+        # the robust score must agree so that a single noisy phase does not fire alone
+        zflag = (zmax > self.zthr) & (rzmax > self.zthr)
+        mask = zflag | spike | dip | drift
+        kind = np.where(spike, "spike", np.where(dip, "dip", np.where(zflag, "z", "drift")))
+        return mask, np.maximum(zmax, rzmax), kind
+
+    def _advance(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Run rows of one block through the state; returns the EWMA mean and sd
+        before each row and whether a CUSUM alarmed on it."""
+        st = self.state
+        a = STREAM_ALPHA
+        # winsorize so a burst of outliers cannot drag the baseline along with it
+        Xc = np.clip(X, st[LO], st[HI])
+
+        mean = _ema(Xc, st[MEAN], a)
+        mean_prev = np.vstack([st[MEAN], mean[:-1]])
+        d = Xc - mean_prev
+        var = _ema((1.0 - a) * d * d, st[VAR], a)
+        var_prev = np.vstack([st[VAR], var[:-1]])
+        sd_prev = np.sqrt(np.maximum(var_prev, 1e-12))
+
+        y = (X - mean_prev) / sd_prev
+        alarm, end = _cusum_alarms(np.hstack([y, -y]) - CUSUM_K, np.concatenate([st[CUSUM_POS], st[CUSUM_NEG]]))
+        st[CUSUM_POS], st[CUSUM_NEG] = end[:3], end[3:]
+
+        # advance: EWMA to its last values; median/MAD once the block is complete
+        st[MEAN], st[VAR] = mean[-1], var[-1]
+        held = self.n % REF_BLOCK
+        self.n += X.shape[0]
+        if self.n % REF_BLOCK:
+            st[PENDING + held:PENDING + held + X.shape[0]] = Xc
+        else:
+            # blend toward the block, MEDIAN_WINDOW readings being a full step
+            block = np.vstack([st[PENDING:PENDING + held], Xc])
+            w = REF_BLOCK / MEDIAN_WINDOW
+            st[MEDIAN] += w * (_median(block) - st[MEDIAN])
+            st[MAD] += w * (_median(np.abs(block - st[MEDIAN])) - st[MAD])
+            st[PENDING:] = 0.0
+            self._set_bounds()
+        return mean_prev, sd_prev, alarm.any(axis=1)
+
+    def _set_bounds(self) -> None:
+        sd = np.sqrt(np.maximum(self.state[VAR], 1e-12))
+        self.state[LO], self.state[HI] = self.state[MEAN] - CLIP_SIGMAS * sd, self.state[MEAN] + CLIP_SIGMAS * sd
+
+
+def load_detector(s, sensor_id: int, sensor_type: Optional[str]) -> SensorDetector:
+    # read-modify-write within the caller's write transaction (row-locked on Postgres)
+    return SensorDetector.load(s.get(SensorState, sensor_id, with_for_update=True), sensor_type)
+
+
+def save_detector(s, sensor_id: int, user_id: int, det: SensorDetector) -> None:
+    s.merge(SensorState(sensor_id=sensor_id, user_id=user_id, n=det.n, state=det.dump(), updated_at=time.time()))
+
+
+if __name__ == "__main__":
+    # Self-check: scoring must not depend on how readings are split into uploads
+    rng = np.random.default_rng(0)
+    X = np.vstack([rng.normal(120.0, 15.0, (2000, 3)), rng.normal(200.0, 5.0, (2000, 3)), rng.normal(60.0, 5.0, (1000, 3))])
+    X[rng.integers(0, X.shape[0], 25)] *= 2.0
+    one = SensorDetector.prior("meter")
+    whole = one.score(X)
+    rows = SensorDetector.prior("meter")
+    split = [np.concatenate(p) for p in zip(*(rows.score(X[i:i + 1]) for i in range(X.shape[0])))]
+    assert (whole[0] == split[0]).all() and (whole[2] == split[2]).all(), "flags depend on batching"
+    assert np.allclose(whole[1], split[1]) and np.allclose(one.state, rows.state), "scores depend on batching"
+    print(f"{int(whole[0].sum())} of {X.shape[0]} readings flagged, same in one batch and row by row")
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import select
+from background import log_failure
+from db import get_session, write_session, Anomaly, Reading, Sensor
+from events import notifier
+from ingest import bulk_insert_anomalies
+from model import MODEL_EXPLANATION
+
+SWEEP_WORKERS = int(os.environ.get("SWEEP_WORKERS", min(8, os.cpu_count() or 1)))
+SWEEP_CHUNK_ROWS = int(os.environ.get("SWEEP_CHUNK_ROWS", 50000))
+SWEEP_WRITE_BATCH = int(os.environ.get("SWEEP_WRITE_BATCH", 5000))
+
+_background = None
+_background_lock = threading.Lock()
+log = logging.getLogger(__name__)
+
+
+def sweep_sensors(user_id: Optional[int] = None) -> List[Tuple[int, int, Optional[str]]]:
+    """(sensor_id, user_id, type) for one user's sensors, or the whole fleet."""
+    q = select(Sensor.id, Sensor.user_id, Sensor.type).order_by(Sensor.id)
+    if user_id is not None:
+        q = q.where(Sensor.user_id == user_id)
+    with get_session() as s:
+        return [tuple(r) for r in s.execute(q).all()]
+
+
+def _sensor_chunks(sensor_id: int, user_id: int, since: Optional[float], until: Optional[float],
+                   chunk_rows: int) -> Iterator[np.ndarray]:
+    q = select(Reading.timestamp, Reading.v1, Reading.v2, Reading.v3).where(Reading.user_id == user_id, Reading.sensor_id == sensor_id)
+    if since is not None:
+        q = q.where(Reading.timestamp >= since)
+    if until is not None:
+        q = q.where(Reading.timestamp < until)
+    q = q.order_by(Reading.timestamp).execution_options(stream_results=True, yield_per=chunk_rows)
+    with get_session() as s:
+        for part in s.execute(q).partitions():
+            yield np.asarray(part, dtype=float)
+
+
+def _flagged_timestamps(sensor_id: int, user_id: int, since: Optional[float], until: Optional[float]) -> np.ndarray:
+    q = select(Anomaly.timestamp).where(Anomaly.user_id == user_id, Anomaly.sensor_id == sensor_id)
+    if since is not None:
+        q = q.where(Anomaly.timestamp >= since)
+    if until is not None:
+        q = q.where(Anomaly.timestamp < until)
+    with get_session() as s:
+        return np.asarray(s.execute(q).scalars().all(), dtype=float)
+
+
+def diagnose_sensor(registry, sensor_id: int, user_id: int, sensor_type: Optional[str], since: Optional[float] = None,
+                    until: Optional[float] = None, chunk_rows: int = SWEEP_CHUNK_ROWS) -> Tuple[int, list]:
+    """Score one sensor's stored readings with its current model, chunk by chunk.
+
+    Returns (readings scored, anomaly records). Readings that already have an
+    anomaly are skipped so repeated sweeps do not duplicate them.
+    """
+    det = registry.get(user_id, sensor_type)
+    seen = _flagged_timestamps(sensor_id, user_id, since, until)
+    n = 0
+    records = []
+    for A in _sensor_chunks(sensor_id, user_id, since, until, chunk_rows):
+        n += A.shape[0]
+        scores, mask = det.score_batch(A[:, 1:])
+        mask &= ~np.isin(A[:, 0], seen)
+        idx = np.flatnonzero(mask)
+        records += [
+            {"user_id": user_id, "sensor_id": sensor_id, "timestamp": t, "score": sc, "explanation": MODEL_EXPLANATION}
+            for t, sc in zip(A[idx, 0].tolist(), scores[idx].tolist())
+        ]
+    return n, records
+
+
+def run_sweep(registry, user_id: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None,
+              workers: int = SWEEP_WORKERS, write_batch: int = SWEEP_WRITE_BATCH) -> dict:
+    """Re-diagnose every sensor of a user (or of every user) across a thread pool.
+
+    Workers only read and score; this thread is the single writer and flushes
+    anomalies in batches of `write_batch` as sensors complete.
+    """
+    t0 = time.perf_counter()
+    sensors = sweep_sensors(user_id)
+    readings = anomalies = 0
+    pending = []
+    users = set()
+
+    def flush():
+        nonlocal pending
+        if pending:
+            with write_session() as s:
+                bulk_insert_anomalies(s, pending)
+            pending = []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sweep") as pool:
+        futures = {pool.submit(diagnose_sensor, registry, sid, uid, stype, since, until): uid for sid, uid, stype in sensors}
+        for fut in as_completed(futures):
+            n, records = fut.result()
+            readings += n
+            anomalies += len(records)
+            if records:
+                users.add(futures[fut])
+            pending += records
+            if len(pending) >= write_batch:
+                flush()
+    flush()
+    for uid in users:
+        notifier.notify(uid)
+    return {"sensors": len(sensors), "readings": readings, "anomalies": anomalies, "seconds": time.perf_counter() - t0}
+
+
+def submit_sweep(registry, user_id: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None):
+    """Run a sweep on a single background thread; sweeps queue behind each other."""
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sweep-job")
+        fut = _background.submit(run_sweep, registry, user_id, since, until)
+    fut.add_done_callback(log_failure(log, f"background sweep for user {'all' if user_id is None else user_id}"))
+    return fut
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import ensure_schema
+    from registry import ModelRegistry
+    ap = argparse.ArgumentParser(description="Re-diagnose stored readings with the current models.")
+    ap.add_argument("--user", type=int, help="limit to one user (default: all sensors)")
+    ap.add_argument("--window", type=float, help="only the last WINDOW seconds")
+    ap.add_argument("--workers", type=int, default=SWEEP_WORKERS)
+    args = ap.parse_args()
+    ensure_schema()
+    since = time.time() - args.window if args.window else None
+    print(run_sweep(ModelRegistry(), args.user, since, workers=args.workers))
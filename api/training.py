@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from db import get_session, Reading, Sensor, ModelArtifact
+
+TRAIN_MAX_SAMPLES = int(os.environ.get("TRAIN_MAX_SAMPLES", 20000))
+TRAIN_CHUNK_ROWS = int(os.environ.get("TRAIN_CHUNK_ROWS", 5000))
+# Training samples from at most this many of the newest rows, so its cost stays flat as history grows
+TRAIN_SCAN_ROWS = int(os.environ.get("TRAIN_SCAN_ROWS", 100_000))
+RETRAIN_MIN_ROWS = int(os.environ.get("RETRAIN_MIN_ROWS", 5000))
+RETRAIN_MAX_AGE = float(os.environ.get("RETRAIN_MAX_AGE", 24 * 3600))
+
+log = logging.getLogger(__name__)
+
+
+def iter_reading_chunks(user_id: int, sensor_type: Optional[str] = None, since: Optional[float] = None,
+                        chunk_rows: int = TRAIN_CHUNK_ROWS, limit: Optional[int] = TRAIN_SCAN_ROWS) -> Iterator[np.ndarray]:
+    """Yield (n, 3) arrays of a user's readings, newest first, without materializing the full history.
+
+    `limit` stops after that many rows (None: all of them).
+    """
+    q = select(Reading.v1, Reading.v2, Reading.v3).where(Reading.user_id == user_id)
+    if sensor_type:
+        # model keys are lowercased while sensors keep the type as it was entered
+        q = q.join(Sensor, Reading.sensor_id == Sensor.id).where(func.lower(Sensor.type) == sensor_type.lower())
+    if since is not None:
+        q = q.where(Reading.timestamp >= since)
+    # newest first along ix_readings_user_ts, so the LIMIT bounds the rows read
+    q = q.order_by(Reading.timestamp.desc())
+    if limit:
+        q = q.limit(limit)
+    with get_session() as s:
+        result = s.execute(q.execution_options(yield_per=chunk_rows))
+        for part in result.partitions():
+            yield np.asarray(part, dtype=float)
+
+
+def reservoir_sample(chunks: Iterator[np.ndarray], k: int, seed: Optional[int] = None) -> Tuple[np.ndarray, int]:
+    """Uniform sample of at most k rows from a stream of chunks (Algorithm R, vectorized per chunk).
+
+    Returns (sample, rows_seen).
+    """
+    rng = np.random.default_rng(seed)
+    res = None
+    filled = 0
+    seen = 0
+    for chunk in chunks:
+        if res is None:
+            res = np.empty((k, chunk.shape[1]), dtype=float)
+        take = min(k - filled, chunk.shape[0])
+        if take:
+            res[filled:filled + take] = chunk[:take]
+            filled += take
+        rest = chunk[take:]
+        if rest.shape[0]:
+            # row i of the stream replaces slot j ~ U[0, i] when j < k
+            j = rng.integers(0, seen + take + np.arange(1, rest.shape[0] + 1))
+            keep = j < k
+            res[j[keep]] = rest[keep]
+        seen += chunk.shape[0]
+    if res is None:
+        return np.empty((0, 3)), 0
+    return res[:filled], seen
+
+
+def collect_training_set(user_id: int, sensor_type: Optional[str] = None, window: Optional[float] = None,
+                         max_samples: int = TRAIN_MAX_SAMPLES) -> Tuple[np.ndarray, int]:
+    """Bounded training set: a reservoir sample of the newest TRAIN_SCAN_ROWS rows,
+    optionally only from the last `window` seconds."""
+    since = time.time() - window if window else None
+    return reservoir_sample(iter_reading_chunks(user_id, sensor_type, since), max_samples)
+
+
+class RetrainScheduler:
+    """Refreshes a user's model off the request path once enough new rows
+    have arrived or the stored model is older than the age threshold."""
+
+    def __init__(self, registry, min_rows: int = RETRAIN_MIN_ROWS, max_age: float = RETRAIN_MAX_AGE,
+                 window: Optional[float] = None, max_samples: int = TRAIN_MAX_SAMPLES):
+        self.registry = registry
+        self.min_rows = min_rows
+        self.max_age = max_age
+        self.window = window
+        self.max_samples = max_samples
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retrain")
+        self._lock = threading.Lock()
+        self._pending = {}   # key -> rows ingested since the last training
+        self._trained_at = {}  # key -> updated_at of the stored model (0 if none)
+        self._inflight = set()
+
+    def _last_trained(self, key) -> float:
+        if key not in self._trained_at:
+            with get_session() as s:
+                art = s.query(ModelArtifact.updated_at).filter_by(user_id=key[0], sensor_type=key[1]).first()
+            self._trained_at[key] = float(art[0]) if art else 0.0
+        return self._trained_at[key]
+
+    def note_ingest(self, user_id: int, rows: int, sensor_type: Optional[str] = None) -> bool:
+        """Record newly ingested rows for the user's model and, when the sensor has a
+        type, that type's model; queue a retrain for each whose threshold is crossed."""
+        keys = [(user_id, "")]
+        if sensor_type and sensor_type.strip():
+            keys.append((user_id, sensor_type.strip().lower()))
+        due = []
+        with self._lock:
+            for key in keys:
+                self._pending[key] = self._pending.get(key, 0) + rows
+                if key in self._inflight:
+                    continue
+                trained_at = self._last_trained(key)
+                if key[1] and not trained_at:
+                    # per-type models are only refreshed once someone has trained one
+                    continue
+                stale = trained_at and time.time() - trained_at > self.max_age
+                if self._pending[key] >= self.min_rows or stale:
+                    due.append(key)
+        return any([self.submit(*key) for key in due])
+
+    def submit(self, user_id: int, sensor_type: Optional[str] = None, window: Optional[float] = None) -> bool:
+        key = (user_id, (sensor_type or "").lower())
+        with self._lock:
+            if key in self._inflight:
+                return False
+            self._inflight.add(key)
+        self._pool.submit(self._run, key, window if window is not None else self.window)
+        return True
+
+    def _run(self, key, window):
+        try:
+            sample, _ = collect_training_set(key[0], key[1] or None, window, self.max_samples)
+            if sample.shape[0]:
+                self.registry.train(key[0], sample, key[1] or None)
+        except Exception:
+            log.exception("retrain for user %s, sensor type %r failed", key[0], key[1] or "all")
+        finally:
+            with self._lock:
+                # empty histories and failures count as refreshed too, so the row and
+                # age thresholds back off instead of resubmitting on every ingest
+                self._pending[key] = 0
+                self._trained_at[key] = time.time()
+                self._inflight.discard(key)
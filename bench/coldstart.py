@@ -0,0 +1,99 @@
+"""Cold-start profile for the serverless entry point.
+
+Each probe runs in a fresh interpreter against a temporary database: it imports
+api/index.py under `-X importtime`, then times the first request to one route
+and records which heavy packages that request pulled in.
+
+    python bench/coldstart.py                # table on stdout
+    python bench/coldstart.py --out cold.json --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import index
+t1 = time.perf_counter()
+c = index.app.test_client()
+# schema setup and account creation are not part of the measured route
+token = c.post('/api/auth/signup', json={'email': 'cold@local', 'password': 'pw'}).json['token']
+h = {'Authorization': 'Bearer ' + token}
+before = {m for m in ("numpy", "sklearn", "scipy") if m in sys.modules}
+method, path = sys.argv[1], sys.argv[2]
+t2 = time.perf_counter()
+r = c.open(path, method=method, headers=h)
+t3 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_request_ms": (t3 - t2) * 1000,
+    "status": r.status_code,
+    "loaded_before": sorted(before),
+    "loaded_after": sorted(m for m in ("numpy", "sklearn", "scipy") if m in sys.modules),
+}))
+"""
+
+ROUTES = [
+    ("GET", "/api/me"),
+    ("GET", "/api/sensors"),
+    ("GET", "/api/readings?limit=100"),
+    ("GET", "/api/anomalies?limit=100"),
+    ("GET", "/api/rooms-summary"),
+    ("POST", "/api/safety-check"),
+]
+
+
+def parse_importtime(stderr: str, top: int) -> dict:
+    """Self import time summed per top-level package from `-X importtime` output (the /api/me probe)."""
+    pkgs = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _cum_us, name = line[len("import time:"):].split("|")
+        pkg = name.strip().split(".")[0]
+        pkgs[pkg] = pkgs.get(pkg, 0) + int(self_us)
+    ranked = sorted(pkgs.items(), key=lambda kv: -kv[1])[:top]
+    return {"total_ms": sum(pkgs.values()) / 1000, "top": [{"package": m, "self_ms": us / 1000} for m, us in ranked]}
+
+
+def probe(method: str, path: str) -> dict:
+    env = dict(os.environ, DB_PATH=os.path.join(tempfile.mkdtemp(prefix="voltguard-cold-"), "cold.db"))
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE, method, path],
+                       cwd=API_DIR, env=env, capture_output=True, text=True, check=True)
+    res = json.loads(p.stdout.strip().splitlines()[-1])
+    res["route"] = f"{method} {path}"
+    return res, p.stderr
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--top", type=int, default=10, help="modules to list in the import profile")
+    ap.add_argument("--out", help="write the report as JSON")
+    args = ap.parse_args()
+
+    routes, stderr = [], ""
+    for method, path in ROUTES:
+        res, err = probe(method, path)
+        stderr = stderr or err
+        routes.append(res)
+    report = {"import_profile": parse_importtime(stderr, args.top), "routes": routes}
+
+    print(f"import index: {routes[0]['import_ms']:.1f} ms (importtime total {report['import_profile']['total_ms']:.1f} ms)")
+    for m in report["import_profile"]["top"]:
+        print(f"  {m['self_ms']:9.1f} ms  {m['package']}")
+    for r in routes:
+        extra = sorted(set(r["loaded_after"]) - set(r["loaded_before"]))
+        print(f"{r['route']:<32} first={r['first_request_ms']:8.1f} ms  status={r['status']}  loaded={','.join(extra) or '-'}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Benchmarks for the API hot paths and the anomaly model.
+
+Seeds a throwaway SQLite database per scale, drives the Flask app through its
+test client and writes latency percentiles, peak traced memory and throughput
+to JSON.
+
+    python bench/run.py                       # 1k, 100k, 1M readings
+    python bench/run.py --scales 1000 --repeat 5 --out results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+
+def measure(fn, repeat: int, units: int = 1) -> dict:
+    """Run fn `repeat` times for latency, then once under tracemalloc for peak memory."""
+    fn()  # warm-up
+    lat = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        lat.append(time.perf_counter() - t)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lat = np.array(lat) * 1000.0
+    return {
+        "repeat": repeat,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p90_ms": float(np.percentile(lat, 90)),
+        "p99_ms": float(np.percentile(lat, 99)),
+        "max_ms": float(lat.max()),
+        "peak_mem_mb": peak / 2**20,
+        "throughput_per_s": units / (np.median(lat) / 1000.0),
+    }
+
+
+def seed(index, headers: dict, n: int, sensors: int = 4) -> list:
+    """Insert n readings spread over `sensors` sensors and the past day, with rollups."""
+    from db import write_session
+    from ingest import bulk_insert_readings
+    from rollups import update_rollups
+
+    c = index.app.test_client()
+    ids = []
+    for i in range(sensors):
+        body = {"name": f"bench-{i}", "room": f"room-{i % 2}", "type": "meter"}
+        ids.append(c.post("/api/sensors", json=body, headers=headers).json["sensor"]["id"])
+    user_id = c.get("/api/me", headers=headers).json["user"]["id"]
+    rng = np.random.default_rng(0)
+    per = n // sensors
+    now = time.time()
+    for sid in ids:
+        for start in range(0, per, 100_000):
+            m = min(100_000, per - start)
+            X = rng.normal(120.0, 15.0, size=(m, 3))
+            ts = now - 86400 + (start + np.arange(m)) * (86400 / per)
+            with write_session() as s:
+                bulk_insert_readings(s, user_id, sid, X, ts)
+                update_rollups(s, user_id, sid, X, ts)
+    return ids
+
+
+def run_scale(n: int, repeat: int, batch: int) -> dict:
+    # Each scale gets a fresh database; modules read DB_PATH at import
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="voltguard-bench-"), "bench.db")
+    # keep background retraining from landing inside timed requests
+    os.environ["RETRAIN_MIN_ROWS"] = str(2**62)
+    os.environ["RETRAIN_MAX_AGE"] = "inf"
+    api_dir = os.path.realpath(API_DIR)
+    for name, mod in list(sys.modules.items()):
+        if os.path.dirname(os.path.realpath(getattr(mod, "__file__", None) or "")) == api_dir:
+            del sys.modules[name]
+    import index
+    from model import AnomalyDetector
+
+    c = index.app.test_client()
+    token = c.post("/api/auth/signup", json={"email": "bench@local", "password": "bench"}).json["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    t = time.perf_counter()
+    ids = seed(index, headers, n)
+    seed_s = time.perf_counter() - t
+
+    rng = np.random.default_rng(1)
+    rows = rng.normal(120.0, 15.0, size=(batch, 3)).tolist()
+    det = AnomalyDetector()
+    csv_n = min(n, 100_000)
+
+    def ingest():
+        r = c.post("/api/readings", json={"sensor_id": ids[0], "data": rows}, headers=headers)
+        assert r.status_code == 200, r.data
+
+    def csv():
+        r = c.get(f"/api/dataset.csv?n={csv_n}")
+        assert r.status_code == 200 and len(r.data) > 0
+
+    cases = {
+        "detector_init": (lambda: AnomalyDetector(), max(1, repeat // 5), 1),
+        "diagnose": (lambda: det.diagnose(rows), repeat, batch),
+        "add_readings": (ingest, repeat, batch),
+        "rooms_summary": (lambda: c.get("/api/rooms-summary", headers=headers), repeat, 1),
+        "list_readings": (lambda: c.get("/api/readings?limit=500", headers=headers), repeat, 500),
+        "dataset_csv": (csv, max(1, repeat // 5), csv_n),
+    }
+    results = {name: measure(fn, rep, units) for name, (fn, rep, units) in cases.items()}
+    return {"readings": n, "seed_seconds": seed_s, "batch_rows": batch, "cases": results}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scales", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--batch", type=int, default=1_000, help="rows per add_readings / diagnose call")
+    ap.add_argument("--out", default=f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = ap.parse_args()
+
+    sys.path.insert(0, API_DIR)
+    report = {
+        "created": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "scales": [],
+    }
+    for n in args.scales:
+        res = run_scale(n, args.repeat, args.batch)
+        report["scales"].append(res)
+        for name, r in res["cases"].items():
+            print(f"{n:>9} {name:<14} p50={r['p50_ms']:9.2f}ms p99={r['p99_ms']:9.2f}ms peak={r['peak_mem_mb']:8.1f}MB")
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,19 @@ export default function Alerts(){
   const [alerts, setAlerts] = useState([]);
   const [error, setError] = useState('');
 
-  async function load(){
-    try{
-      const token = localStorage.getItem('token')||'';
-      const res = await fetch('/api/view-alerts', { headers: { Authorization: token ? `Bearer ${token}` : undefined }});
-      if(!res.ok) throw new Error('Failed to fetch alerts');
-      const data = await res.json();
-      setAlerts(data.alerts || []);
+  useEffect(()=>{
+    // The stream replays the latest anomalies, then pushes new ones; EventSource
+    // reconnects and resumes from Last-Event-ID
+    const token = localStorage.getItem('token')||'';
+    const es = new EventSource(`/api/alerts/stream?backlog=50&access_token=${encodeURIComponent(token)}`);
+    es.addEventListener('anomaly', e=>{
+      const a = JSON.parse(e.data);
+      setAlerts(prev => [...prev, a].slice(-50));
       setError('');
-    }catch(e){ setError(e.message); }
-  }
-
-  useEffect(()=>{ load(); const t = setInterval(load, 5000); return ()=>clearInterval(t); },[]);
+    });
+    es.onerror = ()=>{ if(es.readyState === EventSource.CLOSED) setError('Failed to fetch alerts'); };
+    return ()=>es.close();
+  },[]);
 
   return (
     <div style={{display:'grid', gap:10}}>
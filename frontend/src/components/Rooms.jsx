@@ -3,21 +3,21 @@ import BarChart from './BarChart.jsx';
 
 export default function Rooms(){
   const [rooms, setRooms] = useState([]);
-  const [limit, setLimit] = useState(1000);
+  const [windowSec, setWindowSec] = useState(86400);
   const token = localStorage.getItem('token')||'';
 
   async function load(){
-    const res = await fetch(`/api/rooms-summary?limit=${limit}`, { headers:{ Authorization:`Bearer ${token}` }});
+    const res = await fetch(`/api/rooms-summary?window=${windowSec}`, { headers:{ Authorization:`Bearer ${token}` }});
     const data = await res.json(); if(data.ok) setRooms(data.rooms);
   }
-  useEffect(()=>{ load(); },[limit]);
+  useEffect(()=>{ load(); },[windowSec]);
 
   return (
     <div style={{display:'grid', gap:12}}>
       <div style={{display:'flex', gap:10, alignItems:'center'}}>
-        <div className="subtitle">Recent readings window:</div>
-        <select value={limit} onChange={e=>setLimit(Number(e.target.value))}>
-          {[200,500,1000,2000,5000].map(n=> <option key={n} value={n}>{n}</option>)}
+        <div className="subtitle">Time window:</div>
+        <select value={windowSec} onChange={e=>setWindowSec(Number(e.target.value))}>
+          {[[3600,'1 hour'],[86400,'24 hours'],[604800,'7 days'],[2592000,'30 days']].map(([n,label])=> <option key={n} value={n}>{label}</option>)}
         </select>
         <button className="btn btn-blue" onClick={load}>Refresh</button>
       </div>
@@ -0,0 +1,51 @@
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pytest
+
+# The api modules bind their engine and cold-store directory at import, so point
+# them at a throwaway SQLite file before any of them is loaded
+_TMP = tempfile.mkdtemp(prefix="voltguard-tests-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "test.db")
+os.environ["COLD_DIR"] = os.path.join(_TMP, "cold")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+import db  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    db.ensure_schema()
+    yield
+    db.engine.dispose()
+    shutil.rmtree(_TMP, ignore_errors=True)
+
+
+@pytest.fixture
+def sensor():
+    """A new user with one meter, so tests sharing the database never see each other's rows;
+    returns (user_id, sensor_id)."""
+    n = next(_ids)
+    with db.write_session() as s:
+        user = db.User(email=f"user{n}@example.com", password_hash="-")
+        s.add(user)
+        s.flush()
+        meter = db.Sensor(user_id=user.id, name=f"Meter {n}", room="Lab", type="meter")
+        s.add(meter)
+        s.flush()
+        ids = user.id, meter.id
+    return ids
+
+
+@pytest.fixture
+def readings():
+    """(X, ts) with `n` three-phase rows one second apart from `start`."""
+    def make(n: int, start: float = 1_700_000_000.0, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        return rng.normal(120.0, 15.0, (n, 3)), start + np.arange(n, dtype=float)
+    return make
@@ -0,0 +1,72 @@
+import numpy as np
+from sqlalchemy import func, select
+from coldstore import compact
+from db import get_session, write_session, ColdChunk, Reading
+from ingest import LOOKUP_CHUNK, SensorBatch, append_readings, newest_stored, stored_mask
+
+
+def store(user_id, sensor_id, X, ts, cold_before=None):
+    """Store readings, then compact those older than `cold_before` into 128-row cold chunks."""
+    with write_session() as s:
+        append_readings(s, user_id, sensor_id, X, ts)
+    if cold_before is not None:
+        assert compact(cold_before, user_id, chunk_rows=128) == int((ts < cold_before).sum())
+
+
+def stored_timestamps(sensor_id):
+    with get_session() as s:
+        return s.execute(select(Reading.timestamp).where(Reading.sensor_id == sensor_id)
+                         .order_by(Reading.timestamp)).scalars().all()
+
+
+def test_stored_mask_finds_hot_and_cold_duplicates(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(1000)
+    store(user_id, sensor_id, X, ts, cold_before=ts[500])
+    with get_session() as s:
+        assert s.execute(select(func.count()).where(ColdChunk.sensor_id == sensor_id)).scalar() == 4
+        # cold, hot, new inside a cold chunk's range, new after everything, cold again (repeated)
+        batch = np.array([ts[10], ts[600], ts[200] + 0.5, ts[-1] + 1.0, ts[10]])
+        assert stored_mask(s, user_id, sensor_id, batch).tolist() == [True, True, False, False, True]
+        assert newest_stored(s, user_id, sensor_id) == ts[-1]
+
+
+def test_stored_mask_looks_up_more_timestamps_than_one_query_takes(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(3 * LOOKUP_CHUNK)
+    store(user_id, sensor_id, X, ts, cold_before=ts[LOOKUP_CHUNK])
+    batch = np.concatenate([ts, ts[-1] + 1.0 + np.arange(100.0)])[::-1]
+    with get_session() as s:
+        mask = stored_mask(s, user_id, sensor_id, batch)
+    assert mask.sum() == ts.shape[0] and not mask[:100].any()
+
+
+def test_retried_batch_skips_compacted_readings(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(600)
+    store(user_id, sensor_id, X[:400], ts[:400], cold_before=ts[300])
+    # a retry of an upload that overlaps history both compacted and hot
+    batch = SensorBatch(user_id, sensor_id, "meter", X[200:], ts[200:], np.zeros(400, dtype=bool))
+    with get_session() as s:
+        batch.drop_stored(s)
+    assert batch.ts.tolist() == ts[400:].tolist()
+    with write_session() as s:
+        assert batch.write(s) == 200
+    hot = stored_timestamps(sensor_id)
+    assert hot == ts[300:].tolist()
+
+
+def test_stamped_rows_are_new_even_on_a_stored_timestamp(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(10)
+    store(user_id, sensor_id, X, ts)
+    # the last two rows were stamped by the server, at an instant already taken
+    stamped = np.array([False] * 8 + [True, True])
+    batch_ts = np.concatenate([ts[:8], [ts[-1], ts[-1] + 1e-6]])
+    batch = SensorBatch(user_id, sensor_id, "meter", X, batch_ts, stamped)
+    with get_session() as s:
+        batch.drop_stored(s)
+    assert batch.stamped.all() and batch.ts.shape[0] == 2
+    with write_session() as s:
+        assert batch.write(s) == 2
+    assert len(stored_timestamps(sensor_id)) == 12
@@ -0,0 +1,94 @@
+import pytest
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.orm import sessionmaker
+import db
+from rollups import MINUTE
+
+# Tables as the first release created them: no unique readings index, no
+# rollups and no schema_meta, i.e. schema version 0
+V0_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR(255) NOT NULL, password_hash VARCHAR(255) NOT NULL,
+                    created_at DATETIME);
+CREATE UNIQUE INDEX ix_users_email ON users (email);
+CREATE TABLE sensors (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id),
+                      name VARCHAR(120) NOT NULL, room VARCHAR(120) NOT NULL, type VARCHAR(120));
+CREATE INDEX ix_sensors_user_id ON sensors (user_id);
+CREATE TABLE readings (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, sensor_id INTEGER NOT NULL REFERENCES sensors (id),
+                       timestamp FLOAT, v1 FLOAT NOT NULL, v2 FLOAT NOT NULL, v3 FLOAT NOT NULL);
+CREATE INDEX ix_readings_user_id ON readings (user_id);
+CREATE INDEX ix_readings_sensor_id ON readings (sensor_id);
+CREATE INDEX ix_readings_timestamp ON readings (timestamp);
+CREATE TABLE anomalies (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, sensor_id INTEGER, timestamp FLOAT,
+                        score FLOAT NOT NULL, explanation TEXT);
+"""
+
+
+@pytest.fixture
+def v0_database(tmp_path, monkeypatch):
+    """Swap the db module over to a version 0 SQLite file, as an old deployment would start."""
+    engine = db._make_engine(f"sqlite:///{tmp_path / 'v0.db'}")
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engine, autoflush=False, future=True))
+    monkeypatch.setattr(db, "WriteSessionLocal", sessionmaker(
+        bind=engine.execution_options(sqlite_immediate=True), autoflush=False, future=True))
+    monkeypatch.setattr(db, "_schema_ok", False)
+    raw = engine.raw_connection()
+    try:
+        raw.driver_connection.executescript(V0_SCHEMA)
+    finally:
+        raw.close()
+    yield engine
+    engine.dispose()
+
+
+def add_readings(engine, rows):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, email, password_hash) VALUES (1, 'old@example.com', '-')"))
+        conn.execute(text("INSERT INTO sensors (id, user_id, name, room, type) VALUES (1, 1, 'Main', 'Hall', 'meter')"))
+        conn.execute(text("INSERT INTO readings (user_id, sensor_id, timestamp, v1, v2, v3) VALUES (1, 1, :t, :v, :v, :v)"),
+                     [{"t": t, "v": v} for t, v in rows])
+
+
+def indexes(engine):
+    return {ix["name"] for ix in inspect(engine).get_indexes("readings")}
+
+
+def count(table):
+    with db.get_session() as s:
+        return s.execute(select(func.count()).select_from(table)).scalar()
+
+
+# ten distinct timestamps across two minutes, three of them stored twice
+ROWS = [(600.0 + 13 * i, 100.0 + i) for i in range(10)] + [(600.0, 999.0), (639.0, 999.0), (717.0, 999.0)]
+
+
+def test_cold_start_leaves_history_migration_pending(v0_database):
+    add_readings(v0_database, ROWS)
+    db.ensure_schema()
+    # request path: new tables exist, but nothing that scans the readings has run
+    assert db._schema_version() is None
+    assert count(db.Reading) == len(ROWS)
+    assert "uq_readings_sensor_ts" not in indexes(v0_database)
+    assert inspect(v0_database).has_table("rollups") and count(db.Rollup) == 0
+
+
+def test_init_db_dedupes_backfills_and_records_version(v0_database):
+    add_readings(v0_database, ROWS)
+    db.ensure_schema()
+    db.init_db()
+    assert db._schema_version() == db.SCHEMA_VERSION
+    assert "uq_readings_sensor_ts" in indexes(v0_database)
+    assert not indexes(v0_database) & set(db.OBSOLETE_INDEXES)
+    with db.get_session() as s:
+        kept = s.execute(select(db.Reading.timestamp, db.Reading.v1).order_by(db.Reading.timestamp)).all()
+        minutes = s.execute(select(db.Rollup.bucket, db.Rollup.count).where(db.Rollup.resolution == MINUTE)
+                            .order_by(db.Rollup.bucket)).all()
+    # the first copy of each timestamp survives, and the rollups count it once
+    assert [tuple(r) for r in kept] == ROWS[:10]
+    assert [tuple(r) for r in minutes] == [(600.0, 5), (660.0, 5)]
+
+
+def test_cold_start_migrates_an_empty_database(v0_database):
+    db.ensure_schema()
+    assert db._schema_version() == db.SCHEMA_VERSION
+    assert "uq_readings_sensor_ts" in indexes(v0_database)
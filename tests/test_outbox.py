@@ -0,0 +1,102 @@
+import time
+import numpy as np
+import pytest
+from sqlalchemy import delete, select
+import outbox
+from db import get_session, write_session, IngestOutbox, Reading
+from registry import ModelRegistry
+
+
+@pytest.fixture(autouse=True)
+def empty_outbox():
+    # claim() takes the oldest batches of every user, so start each test from nothing
+    with write_session() as s:
+        s.execute(delete(IngestOutbox))
+
+
+@pytest.fixture(scope="module")
+def registry():
+    return ModelRegistry()
+
+
+def enqueue(user_id, sensor_id, X, ts):
+    with write_session() as s:
+        return outbox.enqueue(s, user_id, sensor_id, X, ts, np.zeros(ts.shape[0], dtype=bool))
+
+
+def stored_count(sensor_id):
+    with get_session() as s:
+        return len(s.execute(select(Reading.id).where(Reading.sensor_id == sensor_id)).all())
+
+
+def test_claim_leases_until_expiry(sensor, readings):
+    X, ts = readings(20)
+    first, second = enqueue(*sensor, X[:10], ts[:10]), enqueue(*sensor, X[10:], ts[10:])
+    assert [c[0] for c in outbox.claim(max_rows=15, lease=0.2)] == [first]
+    assert [c[0] for c in outbox.claim(lease=0.2)] == [second]
+    assert outbox.claim() == []
+    # a worker that dies holding the lease delays its batches, but does not lose them
+    time.sleep(0.25)
+    claimed = outbox.claim()
+    assert [c[0] for c in claimed] == [first, second]
+    assert np.array_equal(outbox._rows(claimed[0][3])[:, 0], ts[:10])
+
+
+def test_failed_batches_retry_then_wait_for_requeue(monkeypatch, registry, sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(50)
+    enqueue(user_id, sensor_id, X, ts)
+    monkeypatch.setattr(outbox, "OUTBOX_RETRY_DELAY", 0.0)
+    write = outbox._write
+
+    def failing(batches, ids):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(outbox, "_write", failing)
+    for _ in range(outbox.OUTBOX_MAX_ATTEMPTS):
+        assert outbox.drain(registry)["failed"] == 1
+    with get_session() as s:
+        item = s.execute(select(IngestOutbox)).scalar_one()
+        assert (item.attempts, item.error) == (outbox.OUTBOX_MAX_ATTEMPTS, "RuntimeError: disk full")
+    assert outbox.pending() == {"batches": 0, "readings": 0, "failed": 1}
+    assert outbox.drain(registry)["batches"] == 0
+
+    monkeypatch.setattr(outbox, "_write", write)
+    assert outbox.requeue() == 1
+    result = outbox.drain(registry)
+    assert (result["failed"], result["inserted"]) == (0, 50)
+    assert outbox.pending() == {"batches": 0, "readings": 0, "failed": 0}
+    assert stored_count(sensor_id) == 50
+
+
+def test_one_failing_sensor_does_not_hold_back_the_others(monkeypatch, registry, sensor, readings):
+    X, ts = readings(30)
+    enqueue(*sensor, X, ts)
+    ok_user, ok_sensor = sensor
+    # a batch for a sensor that the worker fails on, queued after the good one
+    bad_sensor = ok_sensor + 10_000
+    enqueue(ok_user, bad_sensor, X, ts)
+    batches = outbox._batches
+
+    def flaky(registry, groups):
+        if any(key[1] == bad_sensor for key in groups):
+            raise RuntimeError("cannot score")
+        return batches(registry, groups)
+
+    monkeypatch.setattr(outbox, "_batches", flaky)
+    result = outbox.drain(registry)
+    assert (result["batches"], result["inserted"], result["failed"]) == (2, 30, 1)
+    assert stored_count(ok_sensor) == 30
+    assert outbox.pending()["batches"] == 1
+
+
+def test_redelivered_batch_is_stored_once(registry, sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(40)
+    enqueue(user_id, sensor_id, X, ts)
+    enqueue(user_id, sensor_id, X, ts)
+    assert outbox.drain(registry)["inserted"] == 40
+    enqueue(user_id, sensor_id, X[20:], ts[20:])
+    result = outbox.drain(registry)
+    assert (result["batches"], result["inserted"]) == (1, 0)
+    assert stored_count(sensor_id) == 40
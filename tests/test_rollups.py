@@ -0,0 +1,54 @@
+import numpy as np
+from sqlalchemy import select
+from db import write_session, get_session, Rollup
+from ingest import append_readings, bulk_insert_readings
+from rollups import RESOLUTIONS, append_rollups, bucket_stats, rebuild_rollups, update_rollups
+
+COLUMNS = ("resolution", "bucket", "count", "sum", "min", "max", "last_ts", "last_v1", "last_v2", "last_v3")
+
+
+def stored(sensor_id):
+    with get_session() as s:
+        rows = s.execute(select(*(getattr(Rollup, c) for c in COLUMNS))
+                         .where(Rollup.sensor_id == sensor_id).order_by(Rollup.resolution, Rollup.bucket)).all()
+    return np.asarray(rows, dtype=float)
+
+
+def test_bucket_stats_groups_by_bucket():
+    X = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [0.5, 9.0, 1.0]])
+    ts = np.array([125.0, 61.0, 170.0])
+    first, second = bucket_stats(X, ts, 60)
+    assert (first["bucket"], first["count"], first["sum"]) == (60.0, 1, 15.0)
+    assert (second["bucket"], second["count"], second["sum"], second["min"], second["max"]) == (120.0, 2, 16.5, 0.5, 9.0)
+    # the latest reading of the bucket, not the last one in the batch
+    assert (second["last_ts"], second["last_v1"]) == (170.0, 0.5)
+
+
+def test_out_of_order_batches_match_a_rebuild(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(5000)
+    order = np.random.default_rng(1).permutation(ts.shape[0])
+    with write_session() as s:
+        for part in np.array_split(order, 7):
+            bulk_insert_readings(s, user_id, sensor_id, X[part], ts[part])
+            update_rollups(s, user_id, sensor_id, X[part], ts[part])
+    merged = stored(sensor_id)
+    assert rebuild_rollups(user_id) == ts.shape[0]
+    assert np.allclose(merged, stored(sensor_id))
+    assert merged[merged[:, 0] == RESOLUTIONS[0], 2].sum() == ts.shape[0]
+
+
+def test_append_rollups_matches_update_rollups(sensor, readings):
+    user_id, sensor_id = sensor
+    X, ts = readings(3 * 86400 // 50, start=1_700_000_030.0)
+    ts = ts[0] + (ts - ts[0]) * 50  # one reading every 50 s across three days
+    first, rest = slice(0, 1000), slice(1000, None)
+    with write_session() as s:
+        # the second batch continues the last minute, hour and day of the first
+        for part in (first, rest):
+            append_readings(s, user_id, sensor_id, X[part], ts[part])
+            append_rollups(s, user_id, sensor_id, X[part], ts[part])
+    appended = stored(sensor_id)
+    rebuild_rollups(user_id)
+    assert appended.shape == stored(sensor_id).shape
+    assert np.allclose(appended, stored(sensor_id))
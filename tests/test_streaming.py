@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import streaming
+from db import SensorState
+from streaming import SensorDetector, _ema
+
+
+def series(n=3000, seed=0):
+    """A meter that shifts level twice, with a few spikes."""
+    rng = np.random.default_rng(seed)
+    X = np.vstack([rng.normal(120.0, 15.0, (n // 2, 3)), rng.normal(200.0, 5.0, (n // 3, 3)),
+                   rng.normal(60.0, 5.0, (n - n // 2 - n // 3, 3))])
+    X[rng.integers(0, n, 20)] *= 2.0
+    return X
+
+
+def score_in_parts(X, sizes, round_trip=False):
+    """Score X in consecutive uploads of the given sizes; optionally reload the state between them."""
+    det = SensorDetector.prior("meter")
+    parts, i = [], 0
+    for size in sizes:
+        parts.append(det.score(X[i:i + size]))
+        i += size
+        if round_trip:
+            det = SensorDetector.load(SensorState(n=det.n, state=det.dump()), "meter")
+    return [np.concatenate(p) for p in zip(*parts)], det
+
+
+def test_scores_do_not_depend_on_batching():
+    X = series()
+    (mask, score, kind), whole = score_in_parts(X, [X.shape[0]])
+    assert mask.any() and (kind[mask] == "spike").any() and (kind[mask] == "drift").any()
+    for sizes, round_trip in (([1] * X.shape[0], False), ([7, 33, 100, 1, 500] * 4 + [436], True)):
+        (m, sc, k), det = score_in_parts(X, sizes, round_trip)
+        assert (m == mask).all() and (k == kind).all()
+        assert np.allclose(sc, score) and np.allclose(det.state, whole.state) and det.n == whole.n
+
+
+@pytest.mark.parametrize("a", [1e-6, 0.01, 0.5, 0.9, 0.999])
+def test_ema_matches_the_recursion(a):
+    u = np.random.default_rng(2).normal(100.0, 10.0, (1000, 3))
+    s0 = np.array([50.0, 100.0, 150.0])
+    expected, s = np.empty_like(u), s0
+    for t in range(u.shape[0]):
+        s = (1 - a) * s + a * u[t]
+        expected[t] = s
+    out = _ema(u, s0, a)
+    assert np.isfinite(out).all()
+    assert np.allclose(out, expected)
+
+
+@pytest.mark.parametrize("a", [1e-4, 0.5, 0.999])
+def test_state_stays_finite_for_any_alpha(monkeypatch, a):
+    monkeypatch.setattr(streaming, "STREAM_ALPHA", a)
+    det = SensorDetector.prior("meter")
+    mask, score, _ = det.score(series(2000))
+    assert np.isfinite(score).all() and np.isfinite(det.state).all()
+    assert not mask.all()
+
+
+def test_state_saved_before_blocks_loads_into_an_open_block():
+    old = SensorDetector.prior("meter").state[:streaming.PENDING]
+    det = SensorDetector.load(SensorState(n=45, state=old.astype('<f8').tobytes()), "meter")
+    assert det.state.shape == (streaming.STATE_ROWS, 3)
+    assert (det.state[streaming.PENDING:] == det.state[streaming.MEDIAN]).all()
+    assert np.isfinite(det.score(series(200))[1]).all()